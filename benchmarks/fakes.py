@@ -0,0 +1,241 @@
+import asyncio
+import threading, time, zlib
+
+from types import SimpleNamespace
+
+# one 20 ms frame of 48 kHz stereo 16-bit silence, what FFmpegPCMAudio hands out
+FRAME = b'\x00' * 3840
+
+def video_id(index: int, namespace: int = 0) -> str:
+    '''Returns a valid, deterministic 11-character video ID.'''
+    return f'{namespace:03d}{index:08d}'
+
+def video_url(index: int, namespace: int = 0) -> str:
+    return f'https://www.youtube.com/watch?v={video_id(index, namespace)}'
+
+class FakeYoutubeDL:
+    '''Stands in for yt_dlp.YoutubeDL: no network, latency from the class settings.
+
+    Latency for a url is latency * (1 +- jitter), picked from a hash of the
+    url so the same url always takes the same time across runs.
+    '''
+    latency = 0.05
+    jitter = 0.5
+    playlist_length = 200
+    # shared across workers, the thread backend runs them all in this process
+    calls = 0
+    _lock = threading.Lock()
+
+    def __init__(self, options: dict = None):
+        self.options = options or {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    @classmethod
+    def reset(cls):
+        with cls._lock:
+            cls.calls = 0
+
+    def _sleep(self, url: str):
+        with FakeYoutubeDL._lock:
+            FakeYoutubeDL.calls += 1
+        spread = (zlib.crc32(url.encode()) % 1000) / 1000 * 2 - 1
+        time.sleep(max(0.0, self.latency * (1 + self.jitter * spread)))
+
+    def extract_info(self, url: str, download: bool = False):
+        self._sleep(url)
+        if self.options.get('extract_flat'):
+            return self._playlist(url)
+
+        ident = url.split('v=')[-1].split('&')[0]
+        expire = int(time.time()) + 21600
+        return {
+            'id': ident,
+            'title': f'Track {ident}',
+            'webpage_url': url,
+            'uploader': f'Channel {ident[:3]}',
+            'duration': 180,
+            'acodec': 'opus',
+            'ext': 'webm',
+            'url': f'https://rr1---sn-fake.googlevideo.com/videoplayback?expire={expire}&id={ident}'
+        }
+
+    def _playlist(self, url: str):
+        start, end = (int(part) for part in self.options.get('playlist_items', '1-100').split('-'))
+        namespace = zlib.crc32(url.encode()) % 1000
+        end = min(end, self.playlist_length)
+        return {
+            'title': f'Playlist {namespace}',
+            'entries': [
+                {'id': video_id(index, namespace), 'title': f'Track {index}', 'uploader': 'Fake channel', 'duration': 180}
+                for index in range(start, end + 1)
+            ]
+        }
+
+    def prepare_filename(self, data: dict) -> str:
+        return f"{data['id']}.{data.get('ext', 'webm')}"
+
+class FakeFFmpeg:
+    '''Audio source standing in for an FFmpeg process: frames of silence after a spawn delay.'''
+
+    def __init__(self, frames: int, spawn_delay: float = 0.0):
+        self.frames = frames
+        self.spawn_delay = spawn_delay
+        self._started = False
+
+    def read(self):
+        if not self._started:
+            # FFmpeg connecting and probing before its first packet
+            self._started = True
+            if self.spawn_delay:
+                time.sleep(self.spawn_delay)
+        if self.frames <= 0:
+            return b''
+        self.frames -= 1
+        return FRAME
+
+    def is_opus(self):
+        return False
+
+    def cleanup(self):
+        self.frames = 0
+
+class FakeVoiceClient:
+    '''Plays sources on its own thread like discord's AudioPlayer, paced at frame_interval.'''
+
+    def __init__(self, guild, channel, frame_interval: float = 0.0):
+        self.guild = guild
+        self.channel = channel
+        self.frame_interval = frame_interval
+        self.source = None
+        self._connected = True
+        self._stop = None
+        self._thread = None
+
+    def is_connected(self):
+        return self._connected
+
+    def is_playing(self):
+        return self._thread is not None and self._thread.is_alive() and not self._stop.is_set()
+
+    def play(self, source, *, after = None):
+        self.source = source
+        self._stop = stop = threading.Event()
+        self._thread = threading.Thread(target = self._run, args = (stop, after), daemon = True)
+        self._thread.start()
+
+    def _run(self, stop: threading.Event, after):
+        error = None
+        try:
+            while not stop.is_set():
+                # read through self.source so swapping it mid-track works like the real thing
+                if not self.source.read():
+                    break
+                if self.frame_interval:
+                    time.sleep(self.frame_interval)
+        except Exception as e:
+            error = e
+        finally:
+            stop.set()
+            self.source.cleanup()
+        if after:
+            after(error)
+
+    def stop(self):
+        if self._stop:
+            self._stop.set()
+
+    async def disconnect(self, force: bool = False):
+        self.stop()
+        self._connected = False
+        self.guild.voice_client = None
+
+    async def move_to(self, channel):
+        self.channel = channel
+
+class FakeVoiceChannel:
+    def __init__(self, guild, frame_interval: float = 0.0):
+        self.guild = guild
+        self.id = guild.id
+        self.name = f'voice-{guild.id}'
+        self.frame_interval = frame_interval
+
+    async def connect(self, **kwargs):
+        self.guild.voice_client = FakeVoiceClient(self.guild, self, self.frame_interval)
+        return self.guild.voice_client
+
+class FakeGuild:
+    def __init__(self, guild_id: int, frame_interval: float = 0.0):
+        self.id = guild_id
+        self.name = f'guild-{guild_id}'
+        self.voice_client = None
+        self.voice_channel = FakeVoiceChannel(self, frame_interval)
+
+class FakeMessage:
+    def __init__(self, channel):
+        self.channel = channel
+
+    async def edit(self, **kwargs):
+        self.channel.edited += 1
+
+class FakeTextChannel:
+    def __init__(self):
+        self.sent = 0
+        self.edited = 0
+
+    async def send(self, *args, **kwargs):
+        self.sent += 1
+        return FakeMessage(self)
+
+class FakeBot:
+    def __init__(self, loop: asyncio.AbstractEventLoop):
+        self.loop = loop
+        self.user = SimpleNamespace(id = 0)
+        self.channel = FakeTextChannel()
+
+    def get_channel(self, channel_id: int):
+        return self.channel
+
+    async def fetch_channel(self, channel_id: int):
+        return self.channel
+
+class FakeResponse:
+    def __init__(self, created_at: float):
+        self.created_at = created_at
+        # seconds until the interaction was acknowledged, discord allows 3
+        self.ack_latency = None
+
+    def _ack(self):
+        if self.ack_latency is None:
+            self.ack_latency = time.perf_counter() - self.created_at
+
+    def is_done(self):
+        return self.ack_latency is not None
+
+    async def defer(self, **kwargs):
+        self._ack()
+
+    async def send_message(self, *args, **kwargs):
+        self._ack()
+
+class FakeFollowup:
+    async def send(self, *args, **kwargs):
+        pass
+
+class FakeInteraction:
+    '''Just enough of discord.Interaction for the Music commands.'''
+
+    def __init__(self, guild: FakeGuild, user_id: int = 1):
+        self.guild = guild
+        self.user = SimpleNamespace(
+            id = user_id,
+            display_name = f'user-{user_id}',
+            display_avatar = SimpleNamespace(url = ''),
+            voice = SimpleNamespace(channel = guild.voice_channel)
+        )
+        self.response = FakeResponse(time.perf_counter())
+        self.followup = FakeFollowup()
@@ -0,0 +1,330 @@
+'''Offline benchmarks for the Music cog: no network, no Discord connection.
+
+yt-dlp is replaced by benchmarks.fakes.FakeYoutubeDL and FFmpeg/voice by
+fake sources and voice clients, then the cog's commands are driven at
+scale. Results are written as JSON so runs can be diffed.
+
+    python -m benchmarks.run --scenario all --output before.json
+    python -m benchmarks.run --scenario cache --cache-sizes 10,1000,100000
+'''
+import argparse, asyncio, json, os, platform, random, resource, subprocess, sys, tempfile, time, tracemalloc
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from benchmarks.fakes import FakeYoutubeDL, FakeFFmpeg, FakeBot, FakeGuild, FakeInteraction, video_url
+
+def percentiles(samples: list) -> dict:
+    if not samples:
+        return {'count': 0}
+    samples = sorted(samples)
+    pick = lambda q: samples[min(len(samples) - 1, int(q * len(samples)))]
+    return {
+        'count': len(samples),
+        'mean': sum(samples) / len(samples),
+        'p50': pick(0.5),
+        'p95': pick(0.95),
+        'p99': pick(0.99),
+        'max': samples[-1]
+    }
+
+async def wait_until(predicate, timeout: float, interval: float = 0.01) -> bool:
+    deadline = time.perf_counter() + timeout
+    while not predicate():
+        if time.perf_counter() > deadline:
+            return False
+        await asyncio.sleep(interval)
+    return True
+
+class Bench:
+    '''Holds the patched cog and the per-scenario plumbing.'''
+
+    def __init__(self, args, voice):
+        self.args = args
+        self.voice = voice
+        self.music = None
+        self.namespace = 0
+
+    async def setup(self):
+        voice = self.voice
+        # the real build_player spawns FFmpeg, this hands back the same source classes over a fake
+        def build_player(data: dict, volume: float, start_at: float = 0):
+            frames = max(1, self.args.track_frames - int(start_at / 0.02))
+            source = voice.PrebufferedAudio(FakeFFmpeg(frames, self.args.spawn_delay))
+            return voice.YTDLSource(source, data = data, volume = volume, start_at = start_at)
+        voice.build_player = build_player
+
+        # the production rate limit protects YouTube, which isn't involved here
+        voice.scheduler.bucket.rate = self.args.rate
+        voice.scheduler.bucket.burst = voice.scheduler.bucket.tokens = self.args.rate
+
+        self.music = voice.Music(FakeBot(asyncio.get_running_loop()))
+        await self.music.cog_load()
+
+    async def teardown(self):
+        await self.music.cog_unload()
+
+    def fresh(self):
+        '''Resets counters between scenarios and returns a new url namespace so caches start cold.'''
+        from utilities.metrics import Metrics
+        for guild_id in list(self.music.players):
+            player = self.music.players[guild_id]
+            if player.guild.voice_client:
+                player.guild.voice_client.stop()
+            self.music.remove_player(guild_id)
+        metrics = Metrics()
+        self.voice.metrics = self.voice.resolver.metrics = metrics
+        FakeYoutubeDL.reset()
+        self.namespace += 1
+        return metrics
+
+    def guilds(self, count: int, offset: int = 0):
+        return [FakeGuild(10000 * self.namespace + offset + index, self.args.frame_interval) for index in range(count)]
+
+    async def command(self, command, interaction, *args) -> float:
+        started = time.perf_counter()
+        await command.callback(self.music, interaction, *args)
+        return time.perf_counter() - started
+
+    # scenarios
+    async def cache(self) -> dict:
+        '''Write-behind and read-back costs of PrefetchCache at different sizes.'''
+        from utilities.prefetch_cache import PrefetchCache
+        results = {}
+        for size in self.args.cache_sizes:
+            path = os.path.join(self.args.workdir, f'cache-{size}.db')
+            cache = PrefetchCache(path, 3600, max_entries = self.voice.cache_max_entries, table = 'bench')
+            payload = {'title': 'x' * 40, 'uploader': 'y' * 20, 'duration': 180, 'webpage_url': video_url(0)}
+
+            started = time.perf_counter()
+            for index in range(size):
+                cache.put(str(index), payload)
+            put_seconds = time.perf_counter() - started
+
+            started = time.perf_counter()
+            await cache.flush()
+            flush_seconds = time.perf_counter() - started
+
+            keys = [str(random.randrange(size)) for _ in range(min(self.args.cache_reads, size * 10))]
+            warm = []
+            for key in keys:
+                started = time.perf_counter()
+                await cache.get(key)
+                warm.append(time.perf_counter() - started)
+            await cache.close()
+
+            # a new instance starts with nothing in memory, so these read from disk
+            cache = PrefetchCache(path, 3600, max_entries = self.voice.cache_max_entries, table = 'bench')
+            cold = []
+            for key in keys:
+                started = time.perf_counter()
+                await cache.get(key)
+                cold.append(time.perf_counter() - started)
+            await cache.close()
+
+            results[str(size)] = {
+                'puts_per_second': size / put_seconds if put_seconds else None,
+                'flush_seconds': flush_seconds,
+                'file_bytes': os.path.getsize(path),
+                'get_warm_seconds': percentiles(warm),
+                'get_cold_seconds': percentiles(cold)
+            }
+        return results
+
+    async def guilds_scenario(self) -> dict:
+        '''Many guilds each starting playback at once, what a busy evening looks like.'''
+        metrics = self.fresh()
+        guilds = self.guilds(self.args.guilds)
+        interactions = [FakeInteraction(guild) for guild in guilds]
+
+        started = time.perf_counter()
+        latencies = await asyncio.gather(*(
+            self.command(self.music.play_youtube, interaction, video_url(index, self.namespace))
+            for index, interaction in enumerate(interactions)
+        ))
+        await wait_until(lambda: all(guild.voice_client and guild.voice_client.source and guild.voice_client.source.frames for guild in guilds), self.args.timeout)
+        elapsed = time.perf_counter() - started
+
+        return {
+            'guilds': len(guilds),
+            'seconds': elapsed,
+            'guilds_started_per_second': len(guilds) / elapsed,
+            'command_seconds': percentiles(latencies),
+            'ack_seconds': percentiles([interaction.response.ack_latency for interaction in interactions if interaction.response.ack_latency is not None]),
+            'extractions': FakeYoutubeDL.calls,
+            'metrics': metrics.summary()
+        }
+
+    async def long_queue(self) -> dict:
+        '''One guild with a long queue: bulk enqueue, queue paging and track transitions.'''
+        metrics = self.fresh()
+        guild, = self.guilds(1)
+        limit = self.voice.bulk_enqueue_limit
+
+        started = time.perf_counter()
+        enqueue = []
+        for batch in range(0, self.args.queue_length, limit):
+            urls = ' '.join(video_url(index, self.namespace) for index in range(batch, min(batch + limit, self.args.queue_length)))
+            enqueue.append(await self.command(self.music.play_many, FakeInteraction(guild), urls))
+        enqueue_seconds = time.perf_counter() - started
+
+        pages = []
+        for page in range(1, self.args.queue_length // self.voice.queue_page_size + 2):
+            pages.append(await self.command(self.music.show_queue, FakeInteraction(guild), page))
+
+        player = self.music.players[guild.id]
+        target = min(self.args.tracks_played, self.args.queue_length)
+        started = time.perf_counter()
+        await wait_until(lambda: self.args.queue_length - len(player.queue) >= target, self.args.timeout)
+        playback_seconds = time.perf_counter() - started
+
+        return {
+            'queue_length': self.args.queue_length,
+            'enqueue_seconds': enqueue_seconds,
+            'enqueue_per_second': self.args.queue_length / enqueue_seconds,
+            'play_many_seconds': percentiles(enqueue),
+            'queue_page_seconds': percentiles(pages),
+            'tracks_played': self.args.queue_length - len(player.queue),
+            'playback_seconds': playback_seconds,
+            'extractions': FakeYoutubeDL.calls,
+            'metrics': metrics.summary()
+        }
+
+    async def burst(self) -> dict:
+        '''Lots of people queueing the same few songs in one guild at the same moment.'''
+        metrics = self.fresh()
+        guild, = self.guilds(1)
+        interactions = [FakeInteraction(guild, user_id = index) for index in range(self.args.burst)]
+        # the resolver lives for the whole run, so only report what this scenario added
+        before = self.voice.resolver.stats()
+
+        started = time.perf_counter()
+        latencies = await asyncio.gather(*(
+            self.command(self.music.play_youtube, interaction, video_url(index % self.args.burst_distinct, self.namespace))
+            for index, interaction in enumerate(interactions)
+        ))
+        elapsed = time.perf_counter() - started
+        # let the batch window close so the announcements are counted
+        await asyncio.sleep(self.voice.announce_batch_window + 0.1)
+
+        return {
+            'requests': self.args.burst,
+            'distinct_urls': self.args.burst_distinct,
+            'seconds': elapsed,
+            'requests_per_second': self.args.burst / elapsed,
+            'command_seconds': percentiles(latencies),
+            'ack_seconds': percentiles([interaction.response.ack_latency for interaction in interactions if interaction.response.ack_latency is not None]),
+            'extractions': FakeYoutubeDL.calls,
+            'announcements_sent': self.music.players[guild.id].announcer.sent,
+            'resolver': {key: value - before[key] for key, value in self.voice.resolver.stats().items() if key in ('hits', 'joins', 'misses')},
+            'metrics': metrics.summary()
+        }
+
+SCENARIOS = {
+    'cache': Bench.cache,
+    'guilds': Bench.guilds_scenario,
+    'long_queue': Bench.long_queue,
+    'burst': Bench.burst
+}
+
+async def run(args, voice) -> dict:
+    bench = Bench(args, voice)
+    await bench.setup()
+    results = {}
+    try:
+        for name in args.scenarios:
+            random.seed(args.seed)
+            tracemalloc.start()
+            started = time.perf_counter()
+            result = await SCENARIOS[name](bench)
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            results[name] = {
+                **result,
+                'wall_seconds': time.perf_counter() - started,
+                'peak_traced_bytes': peak,
+                # process-wide high-water mark, so it only ever grows across scenarios
+                'max_rss_bytes': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * (1 if sys.platform == 'darwin' else 1024)
+            }
+            print(f'{name} done in {results[name]["wall_seconds"]:.2f}s', file = sys.stderr)
+    finally:
+        await bench.teardown()
+    return results
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd = ROOT, capture_output = True, text = True).stdout.strip() or None
+    except OSError:
+        return None
+
+def parse_args():
+    sizes = lambda text: [int(part) for part in text.split(',') if part]
+    parser = argparse.ArgumentParser(description = __doc__, formatter_class = argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--scenario', dest = 'scenarios', default = 'all', help = f'comma separated, from {", ".join(SCENARIOS)} or all')
+    parser.add_argument('--output', help = 'write the JSON here instead of stdout')
+    parser.add_argument('--seed', type = int, default = 1)
+    parser.add_argument('--latency', type = float, default = 0.05, help = 'fake extract_info latency; in seconds')
+    parser.add_argument('--jitter', type = float, default = 0.5, help = 'latency varies by this fraction either way')
+    parser.add_argument('--workers', type = int, default = 4, help = 'extractor threads')
+    parser.add_argument('--rate', type = float, default = 1000, help = 'extractions started per second')
+    parser.add_argument('--spawn-delay', type = float, default = 0.02, help = 'fake FFmpeg time to first packet; in seconds')
+    parser.add_argument('--track-frames', type = int, default = 25, help = '20 ms frames per fake track')
+    parser.add_argument('--frame-interval', type = float, default = 0.001, help = 'time the fake voice client waits between frames; in seconds')
+    parser.add_argument('--cache-sizes', type = sizes, default = [10, 1000, 10000, 100000])
+    parser.add_argument('--cache-reads', type = int, default = 2000)
+    parser.add_argument('--guilds', type = int, default = 200)
+    parser.add_argument('--queue-length', type = int, default = 500)
+    parser.add_argument('--tracks-played', type = int, default = 50)
+    parser.add_argument('--burst', type = int, default = 200)
+    parser.add_argument('--burst-distinct', type = int, default = 10)
+    parser.add_argument('--timeout', type = float, default = 120, help = 'longest a scenario waits for playback; in seconds')
+    args = parser.parse_args()
+
+    args.scenarios = list(SCENARIOS) if args.scenarios == 'all' else args.scenarios.split(',')
+    unknown = set(args.scenarios) - set(SCENARIOS)
+    if unknown:
+        parser.error(f'unknown scenarios {", ".join(sorted(unknown))}')
+    return args
+
+def main():
+    args = parse_args()
+
+    # constants reads these on import, and the caches are created relative to the working directory
+    os.environ.update({
+        'EXTRACTOR_BACKEND': 'thread',
+        'EXTRACTOR_WORKERS': str(args.workers),
+        'NOW_PLAYING_CHANNEL_ID': '1',
+        'AUDIO_CACHE': 'false',
+        'METRICS_PORT': '0'
+    })
+    if args.output:
+        args.output = os.path.abspath(args.output)
+    args.workdir = tempfile.mkdtemp(prefix = 'amoxliatl-bench-')
+    os.chdir(args.workdir)
+
+    import yt_dlp
+    FakeYoutubeDL.latency = args.latency
+    FakeYoutubeDL.jitter = args.jitter
+    # the extractor workers build their YoutubeDL from here
+    yt_dlp.YoutubeDL = FakeYoutubeDL
+
+    from commands import voice
+
+    results = asyncio.run(run(args, voice))
+    report = {
+        'commit': git_commit(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'settings': {key: value for key, value in vars(args).items() if key != 'workdir'},
+        'results': results
+    }
+
+    text = json.dumps(report, indent = 2)
+    if args.output:
+        with open(args.output, 'w') as file:
+            file.write(text)
+    else:
+        print(text)
+
+if __name__ == '__main__':
+    main()
@@ -1,32 +1,51 @@
 import asyncio
+import re, time
 
 import discord
-import yt_dlp
-
-# cache stuff
-import json, os, time
 
+from collections import deque
 from datetime import datetime
 
 from discord.ext import commands
 from discord import app_commands
 
-from constants import version, now_playing_channel_id, cache_file, cache_ttl
-
+from constants import version, now_playing_channel_id, cache_file, cache_ttl, cache_max_entries, metadata_ttl, failure_ttl, idle_timeout
+from constants import extractor_backend, extractor_workers, extractor_timeout, extractor_max_tasks, extractor_rate, extractor_burst
+from constants import stream_expiry_margin, stream_refresh_interval, stream_refresh_depth, stream_retries
+from constants import gapless_playback, gapless_prewarm, gapless_prebuffer_frames, playback_mode
+from constants import lookahead_depth, lookahead_concurrency, bulk_enqueue_limit, queue_page_size
+from constants import playlist_first_page, playlist_page_size, playlist_import_limit
+from constants import audio_cache_enabled, audio_cache_dir, audio_cache_max_bytes, audio_cache_min_plays, audio_cache_download_timeout, audio_cache_download_workers
+from constants import queue_journal_enabled, queue_journal_dir, queue_journal_compact_after, queue_journal_checkpoint_interval, queue_journal_max_age
+from constants import announce_batch_window, metrics_host, metrics_port, loop_watchdog, loop_watchdog_threshold, loop_watchdog_interval
+from constants import search_results, search_cache_size, search_cache_ttl, search_debounce, search_budget, search_min_length
+from constants import resolver_address, resolver_timeout, resolver_retry_interval, resolver_ping_interval
+
+from utilities.announcer import Announcer
+from utilities.audio_cache import AudioCache
 from utilities.create_embed import create_embed
+from utilities.metrics import Metrics, MetricsServer
+from utilities.extractor import ExtractorPool, extract_track, extract_playlist_page, download_audio, search_tracks
+from utilities.prefetch_cache import PrefetchCache
+from utilities.queue_journal import QueueJournal
+from utilities.resolver import Resolver, get_cache_key, get_playlist_id, is_youtube_url, needs_refresh
+from utilities.resolver_service import ResolverClient
+from utilities.search import Searcher
+from utilities.track_queue import QueueEntry, TrackQueue
+from utilities.watchdog import LoopWatchdog
+from utilities.scheduler import ExtractionScheduler, PRIORITY_PLAYBACK, PRIORITY_PREFETCH, PRIORITY_METADATA, PRIORITY_BACKGROUND
 
 # supress errors
 # yt_dlp.utils.bug_reports_message = lambda: ''
 
 ytdl_format_options = {
-    'format': 'bestaudio[ext=m4a]/bestaudio/best',
+    # opus mode prefers formats that can be passed straight through to discord
+    'format': 'bestaudio[acodec=opus]/bestaudio[ext=m4a]/bestaudio/best' if playback_mode == 'opus' else 'bestaudio[ext=m4a]/bestaudio/best',
     'cookiefile': 'cookies.txt',
     'quiet': True,
     'noplaylist': True,
     'nocheckcertificate': True,
     'ignoreerrors': True,
-    'sleep_interval_requests': 1.0,
-    'ratelimit': 50000,
     'source_address': '0.0.0.0', # bind to ipv4 so we don't get buggy ipv6
     'geo_bypass': True,
     'cachedir': False
@@ -37,186 +56,587 @@ ffmpeg_options = {
     'options': '-vn'
 }
 
-ytdl = yt_dlp.YoutubeDL(ytdl_format_options)
-
-class YTDLSource(discord.PCMVolumeTransformer):
-    def __init__(self, source, *, data, volume = 0.5):
-        super().__init__(source, volume)
-
+# each worker builds its own YoutubeDL from ytdl_format_options
+extractor = ExtractorPool(
+    ytdl_format_options,
+    backend = extractor_backend,
+    workers = extractor_workers,
+    timeout = extractor_timeout,
+    max_tasks_per_worker = extractor_max_tasks
+)
+
+# rate limiting against YouTube happens here rather than in ytdl_format_options, so urgent work can go first
+scheduler = ExtractionScheduler(extractor.run, rate = extractor_rate, burst = extractor_burst, concurrency = extractor_workers)
+
+# timings for every stage of a track, per guild and overall
+metrics = Metrics()
+metrics_server = MetricsServer(metrics, metrics_host, metrics_port) if metrics_port else None
+# finds code blocking the event loop, None when disabled
+watchdog = LoopWatchdog(loop_watchdog_threshold, loop_watchdog_interval, metrics = metrics) if loop_watchdog else None
+
+# titles and the like barely ever change, stream urls expire within hours; both live in cache_file
+metadata_cache = PrefetchCache(cache_file, metadata_ttl, max_entries = cache_max_entries, table = 'metadata')
+stream_cache = PrefetchCache(cache_file, cache_ttl, max_entries = cache_max_entries, table = 'streams')
+
+# every extraction should go through this so concurrent requests for a video share one
+local_resolver = Resolver(
+    metadata_cache,
+    stream_cache,
+    scheduler,
+    extract_track,
+    expiry_margin = stream_expiry_margin,
+    metadata_ttl = metadata_ttl,
+    failure_ttl = failure_ttl,
+    metrics = metrics
+)
+
+# worker functions the resolver daemon runs on behalf of bot processes
+shared_functions = {func.__name__: func for func in (extract_playlist_page, search_tracks)}
+
+# with a daemon, every bot process on the host shares its cache and extractor workers; local_resolver is the fallback
+resolver = ResolverClient(
+    local_resolver,
+    resolver_address,
+    timeout = resolver_timeout,
+    retry_interval = resolver_retry_interval,
+    ping_interval = resolver_ping_interval
+) if resolver_address else local_resolver
+
+async def run_search(query: str, priority: int):
+    results = await resolver.submit(search_tracks, query, search_results, priority = priority)
+    # results come with titles, so queueing one never needs to extract them again
+    for result in results:
+        if result['title']:
+            resolver.seed_metadata(result['url'], {**result, 'webpage_url': result['url']})
+    return results
+
+# /play searches and their autocomplete, answered from recent searches and known titles where possible
+searcher = Searcher(
+    run_search,
+    metadata = metadata_cache,
+    max_queries = search_cache_size,
+    ttl = search_cache_ttl,
+    debounce = search_debounce,
+    budget = search_budget,
+    min_length = search_min_length
+)
+
+# every guild's queue on disk so playback survives a restart, None when disabled
+queue_journal = QueueJournal(queue_journal_dir, compact_after = queue_journal_compact_after, max_age = queue_journal_max_age) if queue_journal_enabled else None
+
+# local copies of tracks that get replayed a lot, None when disabled
+audio_cache = AudioCache(audio_cache_dir, audio_cache_max_bytes, min_plays = audio_cache_min_plays) if audio_cache_enabled else None
+
+# downloads take minutes rather than seconds, on the extractor's workers they would leave playback waiting for a free one
+download_pool = ExtractorPool(
+    ytdl_format_options,
+    backend = extractor_backend,
+    workers = audio_cache_download_workers,
+    timeout = audio_cache_download_timeout,
+    max_tasks_per_worker = extractor_max_tasks
+) if audio_cache_enabled else None
+# same bucket as scheduler, youtube sees downloads and extractions alike
+download_scheduler = ExtractionScheduler(download_pool.run, concurrency = audio_cache_download_workers, bucket = scheduler.bucket) if audio_cache_enabled else None
+
+def cache_audio(url: str, video_id: str):
+    '''Downloads a track into the audio cache in the background, on the download workers.'''
+    async def download(directory: str, video_id: str):
+        job = download_scheduler.submit(download_audio, url, directory, video_id, priority = PRIORITY_BACKGROUND, timeout = audio_cache_download_timeout)
+        return await job.future
+
+    asyncio.create_task(audio_cache.download(video_id, download))
+
+class PrebufferedAudio(discord.AudioSource):
+    '''Wraps an audio source so frames can be read ahead before playback starts.'''
+
+    def __init__(self, source: discord.AudioSource):
+        self.source = source
+        self._buffer = deque()
+        # perf_counter times FFmpeg was spawned and first produced a frame, for the first packet latency
+        self.spawned_at = time.perf_counter()
+        self.first_frame_at = None
+
+    def _read_source(self):
+        frame = self.source.read()
+        if frame and self.first_frame_at is None:
+            self.first_frame_at = time.perf_counter()
+        return frame
+
+    def prebuffer(self, frames: int):
+        '''Reads up to frames frames ahead. Blocking, so run it in an executor.'''
+        while len(self._buffer) < frames:
+            frame = self._read_source()
+            if not frame:
+                break
+            self._buffer.append(frame)
+
+    def read(self):
+        if self._buffer:
+            return self._buffer.popleft()
+        return self._read_source()
+
+    def is_opus(self):
+        return self.source.is_opus()
+
+    def cleanup(self):
+        self._buffer.clear()
+        self.source.cleanup()
+
+class TrackSource:
+    '''Bookkeeping shared by the sources we hand to the voice client.'''
+
+    def _init_track(self, data: dict, start_at: float):
         self.data = data
 
         self.title = data.get('title')
         self.url = data.get('url')
 
-    @classmethod
-    async def from_url(cls, url, *, loop = None, stream = False):
-        loop = loop or asyncio.get_event_loop()
-
-        # extract() handles getting fresh information so URLs don't expire on us
-        def extract():
-            return ytdl.extract_info(url, download= False)
+        # where in the track FFmpeg was told to start; in seconds
+        self.start_at = start_at
+        # frames handed to the voice client, 0 after playback means the stream never started
+        self.frames = 0
+        # called from the voice thread with a perf_counter timestamp when the first frame goes out
+        self.on_start = None
+        # the QueueEntry being played, set by the player
+        self.entry = None
+
+    def _count(self, frame):
+        if frame:
+            self.frames += 1
+            if self.frames == 1 and self.on_start:
+                self.on_start(time.perf_counter())
+        return frame
+
+    @property
+    def position(self):
+        '''Seconds into the track that have been played, frames are 20 ms each.'''
+        return self.start_at + self.frames * 0.02
+
+class YTDLSource(TrackSource, discord.PCMVolumeTransformer):
+    def __init__(self, source, *, data, volume = 0.5, start_at = 0):
+        super().__init__(source, volume)
+        self._init_track(data, start_at)
 
-        data = await loop.run_in_executor(None, extract)
+    def read(self):
+        return self._count(super().read())
 
-        if 'entries' in data:
-            data = data['entries'][0]
+    @classmethod
+    async def from_url(cls, url, *, loop = None, stream = False):
+        # extract fresh information, skipping the cache, so URLs don't expire on us
+        data = await scheduler.submit(extract_track, url, priority = PRIORITY_PLAYBACK).future
 
-        filename = data['url'] if stream else ytdl.prepare_filename(data)
+        filename = data['stream_url'] if stream else data['filename']
 
         source = discord.FFmpegPCMAudio(filename, **ffmpeg_options)
         return cls(source, data=data)
     
     @classmethod
-    async def get_info(cls, url, *, loop = None):
+    async def get_info(cls, url, *, loop = None, group = None):
         try:
-            loop = loop or asyncio.get_event_loop()
-
-            def extract():
-                return ytdl.extract_info(url, download= False)
-            
-            data = await loop.run_in_executor(None, extract)
-            if 'entries' in data:
-                data = data['entries'][0]
-            return data
+            return await resolver.resolve(url, priority = PRIORITY_METADATA, group = group)
         except Exception as e:
             print(f'Error in {__name__}: {e}')
 
-class Music(commands.Cog):
-    def __init__(self, bot):
-        self.bot = bot
-        self.queue = []
+class YTDLOpusSource(TrackSource, discord.AudioSource):
+    '''Opus packets straight from FFmpeg; volume is applied by FFmpeg, not per frame in Python.'''
+
+    def __init__(self, source, *, data, volume = 1.0, start_at = 0):
+        self.original = source
+        # fixed for the lifetime of the FFmpeg process, changing it means spawning a new one
+        self.volume = volume
+        self._init_track(data, start_at)
+
+    def read(self):
+        return self._count(self.original.read())
+
+    def is_opus(self):
+        return True
+
+    def cleanup(self):
+        self.original.cleanup()
+
+def build_player(data: dict, volume: float, start_at: float = 0) -> TrackSource:
+    '''Builds the audio source for a resolved track. Spawns FFmpeg, so it blocks briefly.'''
+    if data.get('local_path'):
+        # local files don't need the reconnect flags
+        stream_url = data['local_path']
+        before_options = ''
+    else:
+        stream_url = data.get('stream_url') or data.get('url')
+        before_options = ffmpeg_options['before_options']
+    if start_at:
+        before_options = f'-ss {start_at:.2f} {before_options}'
+
+    if playback_mode == 'opus' and data.get('acodec') == 'opus':
+        if volume == 1.0:
+            # nothing to change, so copy the opus packets without decoding them
+            source = discord.FFmpegOpusAudio(stream_url, codec = 'opus', before_options = before_options, options = ffmpeg_options['options'])
+        else:
+            source = discord.FFmpegOpusAudio(stream_url, before_options = before_options, options = f"{ffmpeg_options['options']} -filter:a volume={volume}")
+        return YTDLOpusSource(PrebufferedAudio(source), data=data, volume=volume, start_at=start_at)
+
+    # anything that can't be passed through goes the PCM route
+    source = discord.FFmpegPCMAudio(stream_url, before_options = before_options, options = ffmpeg_options['options'])
+    return YTDLSource(PrebufferedAudio(source), data=data, volume=volume, start_at=start_at)
+
+class GuildPlayer:
+    '''Queue, playback state and voice client for a single guild.'''
+
+    def __init__(self, music, guild: discord.Guild):
+        self.music = music
+        self.bot = music.bot
+        self.guild = guild
+
+        self.queue = TrackQueue()
+        # everything posted to the now playing channel goes through here, off the command's critical path
+        self.announcer = Announcer(music.announce_channel, announce_batch_window)
         self.is_playing = False
-        self.clean_cache()
+        self.voice_client = None
+        # opus passthrough only works at full volume, so that's the default there
+        self.volume = 1.0 if playback_mode == 'opus' else 0.5
+        # the YTDLSource that is playing right now, None once it was skipped or stopped
+        self.current = None
+
+        # gapless mode: (queue entry, YTDLSource) for the next track, started and buffered ahead of time
+        self.prepared = None
+        # perf_counter time the last track ended, for the transition gap
+        self._ended_at = None
+
+        self._idle_task = None
+        self._prewarm_task = None
+        self._refresh_task = None
+        self._closed = False
+        # bumped every time the queue is cleared, so long-running imports know to stop
+        self.generation = 0
+        # voice channel ID last written to the journal
+        self._journaled_channel = None
+        # the entry play_next popped and is still resolving, not journaled as playing yet
+        self._starting = None
+
+    # queue journal
+    def journal(self, op: str, **fields):
+        '''Records a change to this guild's queue, made just before, in the queue journal.'''
+        if not queue_journal or self._closed:
+            return
+        if queue_journal.wants_snapshot(self.guild.id):
+            # the snapshot already includes the change
+            queue_journal.snapshot(self.guild.id, self.snapshot())
+        else:
+            queue_journal.record(self.guild.id, {'op': op, **fields})
+
+    def snapshot(self) -> dict:
+        '''The journal state for this guild right now.'''
+        voice_client = self.guild.voice_client
+        current = self.current
+        # still at the front as far as the journal knows, its 'play' record comes once it starts
+        queue = [self._starting, *self.queue] if self._starting else self.queue
+        return {
+            'channel': voice_client.channel.id if voice_client and voice_client.channel else self._journaled_channel,
+            'volume': self.volume,
+            'current': current.entry.to_dict() if current and current.entry else None,
+            'position': current.position if current else 0,
+            'queue': [entry.to_dict() for entry in queue]
+        }
+
+    def checkpoint(self):
+        '''Journals how far into the current track playback is.'''
+        if self.current:
+            self.journal('position', position = round(self.current.position, 2))
+
+    def restore(self, state: dict):
+        '''Refills the queue from a journal state, the interrupted track first and starting where it left off.'''
+        if state.get('volume') is not None:
+            self.volume = state['volume']
+        if state.get('current'):
+            self.queue.append(QueueEntry.from_dict(state['current'], start_at = state.get('position') or 0))
+        for entry in state.get('queue', []):
+            self.queue.append(QueueEntry.from_dict(entry))
+        # the old journal has the interrupted track as current rather than queued, so start over from here
+        if queue_journal:
+            queue_journal.snapshot(self.guild.id, self.snapshot())
+        self.start_refresher()
+        self.fill_lookahead()
+
+    def enqueue(self, url: str, interaction: discord.Interaction, data: dict = None, title: str = None):
+        '''Adds a url to the queue, with its track data if that is already resolved. Returns the queue position.'''
+        self.cancel_idle()
+        self.start_refresher()
+
+        prefetch = None
+        if data:
+            prefetch = asyncio.get_running_loop().create_future()
+            prefetch.set_result(data)
+
+        entry = QueueEntry.from_interaction(url, interaction, title = title, prefetch = prefetch)
+        self.queue.append(entry)
+        self.journal('append', entry = entry.to_dict())
+        self.fill_lookahead()
+        return len(self.queue)
+
+    def start(self):
+        '''Starts playback if nothing is playing. Returns whether it did.'''
+        if self.is_playing:
+            return False
+        self.is_playing = True
+        asyncio.create_task(self.play_next())
+        return True
+
+    def fill_lookahead(self):
+        '''Keeps the next lookahead_depth entries resolving, at most lookahead_concurrency at a time.'''
+        if self._closed:
+            return
 
-    # song prefetch
-    async def prefetch(self, url: str):
-        '''Prefetches info for the next song in queue'''
-        loop = asyncio.get_running_loop()
-        cache = self.load_cache()
-        key = self.get_cache_key(url)
-
-        # check if cache has data for the key already
-        cache_data = cache.get(key)
-        # if data is not expired, return it
-        if cache_data and time.time() - cache_data.get('timestamp', 0) < cache_ttl:
-            return cache_data['data']
-        
-        def extract():
-            return ytdl.extract_info(url, download = False)
-        
-        try:
-            data = await loop.run_in_executor(None, extract)
-            if 'entries' in data:
-                data = data['entries'][0]
-            
-            final_data = {
-                'title': data.get('title'),
-                'webpage_url': data.get('webpage_url'),
-                'uploader': data.get('uploader'),
-                'stream_url': data['url']
-            }
-
-            # save data to cache
-            cache[key] = {'timestamp': time.time(), 'data': final_data}
-            self.save_cache(cache)
-            return final_data
-        except Exception as e:
-            print(f'Prefetch error for video {url}: {e}')
-            return None
+        running = 0
+        for entry in self.queue.head(lookahead_depth):
+            prefetch_task = entry.prefetch
+            if prefetch_task is None:
+                if running >= lookahead_concurrency:
+                    break
+                prefetch_task = asyncio.create_task(self.music.prefetch(entry.url, group = self.guild.id))
+                # whenever one finishes, the next one in line can start
+                prefetch_task.add_done_callback(lambda _: self.fill_lookahead())
+                entry.prefetch = prefetch_task
+            if not prefetch_task.done():
+                running += 1
+
+    async def resolve_many(self, urls: list):
+        '''Resolves urls with bounded concurrency, yielding (url, data) in order as each one is ready.'''
+        pending = deque()
+        urls = iter(urls)
+        # with nothing playing, the first one is what playback is waiting on
+        priority = PRIORITY_PREFETCH if self.is_playing else PRIORITY_PLAYBACK
+
+        def start_next():
+            nonlocal priority
+            url = next(urls, None)
+            if url is not None:
+                pending.append((url, asyncio.create_task(self.music.prefetch(url, priority = priority, group = self.guild.id))))
+                priority = PRIORITY_PREFETCH
+
+        for _ in range(lookahead_concurrency):
+            start_next()
 
-    # cache loading/saving
-    def load_cache(self):
-        '''Loads the cache saved in cache_file.'''
-        if not os.path.exists(cache_file):
-            return {}
         try:
-            with open(cache_file, 'r', encoding = 'utf-8') as file:
-                return json.load(file)
-        except Exception:
-            return {}
+            while pending:
+                url, task = pending.popleft()
+                start_next()
+                yield url, await task
+        finally:
+            for _, task in pending:
+                task.cancel()
+
+    def clear(self):
+        '''Empties the queue and cancels any prefetch still running for it.'''
+        for entry in self.queue:
+            prefetch_task = entry.prefetch
+            if prefetch_task and not prefetch_task.done():
+                prefetch_task.cancel()
+        self.queue.clear()
+        self.journal('clear')
+        self.generation += 1
+        self.discard_prepared()
+        # extractions nobody else is waiting for don't need to happen anymore
+        resolver.cancel_group(self.guild.id)
+
+    async def iter_playlist(self, url: str):
+        '''Lists a playlist a page at a time, yielding (playlist title, entries) for each page.
+
+        The first page is small so playback can start right away. Entries are
+        only listed here; the lookahead resolves each one as it gets close.
+        '''
+        generation = self.generation
+        start = 1
+        count = playlist_first_page
+        # with nothing playing, the first page is what playback is waiting on
+        priority = PRIORITY_PREFETCH if self.is_playing else PRIORITY_PLAYBACK
+
+        while start <= playlist_import_limit:
+            count = min(count, playlist_import_limit - start + 1)
+            future = resolver.submit(extract_playlist_page, url, start, count, priority = priority, group = self.guild.id)
+            await asyncio.wait([future])
+            # stop if the queue was cleared (which also cancels the job) while we waited
+            if future.cancelled() or self.generation != generation:
+                return
 
-    def save_cache(self, cache: dict):
-        '''Saves the dict in cache in the cache file defined in cache_file.'''
-        try:
-            with open(cache_file, 'w', encoding = 'utf-8') as file:
-                json.dump(cache, file)
-        except Exception as e:
-            print(f'Cache dump failed! Error: {e}')
-    
-    def get_cache_key(self, url: str):
-        '''Converts a url into its ID form, to be used in the cache.'''
-        if 'v=' in url:
-            # remove everything after v= and after the & for extra data
-            return url.split('v=')[1].split('&')[0]
-        elif 'youtu.be/' in url:
-            # if it's a youtu.be link get everything after the slash and before the ? for extra data
-            return url.split('youtu.be/')[1].split('?')[0]
-    
-    def clean_cache(self):
-        '''Deletes expired entries from cache.'''
-        try:
-            cache = self.load_cache()
-            now = time.time()
+            page = future.result()
+            if not page:
+                return
+            # the listing already has titles, so the queue and announcements don't need to extract them
+            for entry in page['entries']:
+                if entry['title']:
+                    resolver.seed_metadata(entry['url'], {**entry, 'webpage_url': entry['url']})
+            yield page['title'], page['entries']
+            if page['complete']:
+                return
 
-            updated = {key: value for key, value in cache.items() if now - value.get("timestamp", 0) < cache_ttl}
-            if len(updated) != len(cache):
-                self.save_cache(updated)
-        except Exception as e:
-            print(f'Cache cleanup failed! {e}')
+            start += count
+            count = playlist_page_size
+            priority = PRIORITY_PREFETCH
+
+    def release(self, entries: list):
+        '''Stops prefetching entries that left the lookahead window, or the queue altogether.'''
+        window = self.queue.head(lookahead_depth)
+        for entry in entries:
+            prefetch_task = entry.prefetch
+            if prefetch_task is None or prefetch_task.done() or any(entry is other for other in window):
+                continue
+            prefetch_task.cancel()
+            # picked up again by fill_lookahead if it comes back into the window
+            entry.prefetch = None
+            # the resolver shields the extraction from that cancel, so drop our interest in its job too;
+            # unless the same url is also coming up, which shares the job
+            if not any(other.url == entry.url for other in window):
+                resolver.release(entry.url, self.guild.id)
+
+    def remove(self, index: int) -> QueueEntry:
+        '''Removes the entry at a 0-based queue index.'''
+        entry = self.queue.remove(index)
+        self.journal('remove', index = index)
+        self.release([entry])
+        self.fill_lookahead()
+        return entry
+
+    def move(self, source: int, destination: int) -> QueueEntry:
+        '''Moves an entry between two 0-based queue indexes.'''
+        window = self.queue.head(lookahead_depth)
+        entry = self.queue.move(source, destination)
+        self.journal('move', **{'from': source, 'to': destination})
+        self.release(window)
+        self.fill_lookahead()
+        return entry
+
+    def shuffle(self):
+        window = self.queue.head(lookahead_depth)
+        self.queue.shuffle()
+        if queue_journal:
+            # every position changed, a snapshot is smaller than describing that
+            queue_journal.snapshot(self.guild.id, self.snapshot())
+        self.release(window)
+        self.fill_lookahead()
+
+    async def resolve(self, entry: QueueEntry, priority: int = PRIORITY_PLAYBACK):
+        '''Returns fresh track data for a queue entry, using its prefetch when that is usable.'''
+        prefetch_task = entry.prefetch
+        data = None
+        if prefetch_task and prefetch_task.done() and not prefetch_task.cancelled():
+            try:
+                data = prefetch_task.result()
+            except Exception as e:
+                print(f"Prefetch failed: {e}")
 
-    async def play_next(self, guild: discord.Guild):
+        # with a local copy the stream url doesn't matter, only the metadata
+        local_path = audio_cache.lookup(get_cache_key(entry.url)) if audio_cache else None
+        if local_path:
+            if not data:
+                data = await self.music.prefetch(entry.url, priority = priority, group = self.guild.id)
+            return {**data, 'local_path': local_path} if data else None
+
+        # a stream url that failed or is about to expire gets extracted again
+        refresh = entry.retries > 0 or bool(data and needs_refresh(data, stream_expiry_margin))
+        if not data or refresh:
+            # joins a prefetch that is still running and moves it up in the scheduler
+            data = await self.music.prefetch(entry.url, priority = priority, group = self.guild.id, refresh = refresh)
+        return data
+
+    async def play_next(self):
         '''Plays the next item in the queue.'''
+        # an after callback may still fire for a player that was already torn down
+        if self._closed:
+            return
+
         if not self.queue:
             self.is_playing = False
+            if self.current is None:
+                self.journal('idle')
+            self.schedule_idle()
             return
 
-        next_item = self.queue.pop(0)
-        interaction = next_item['interaction']
-        voice_client = guild.voice_client
+        next_item = self.queue.popleft()
+        self._starting = next_item
+        picked_at = time.perf_counter()
+        voice_client = self.guild.voice_client
+        self.voice_client = voice_client
 
         # if client is disconnected stop playback
         if not voice_client or not voice_client.is_connected():
+            self._starting = None
             self.is_playing = False
+            self.clear()
+            self.schedule_idle()
             return
 
-        prefetch_task = next_item.get('prefetch')
-        data = None
-        if prefetch_task:
-            try:
-                data = await asyncio.wait_for(prefetch_task, timeout=10)
-            except Exception as e:
-                print(f"Prefetch failed: {e}")
-
-        if not data:
-            data = await self.prefetch(next_item['url'])
+        # in gapless mode the next track may already be running and buffered, swap it straight in
+        if self.prepared and isinstance(self.prepared[1], YTDLOpusSource) and self.prepared[1].volume != self.volume:
+            # prepared at a different volume, which an opus source can't change
+            self.discard_prepared()
 
-        stream_url = data.get('stream_url') or data.get('url')
-        source = discord.FFmpegPCMAudio(stream_url, **ffmpeg_options)
-        player = YTDLSource(source, data=data)
+        if self.prepared and self.prepared[0] is next_item:
+            player = self.prepared[1]
+            self.prepared = None
+            player.volume = self.volume
+            metrics.observe('prefetch_wait_seconds', 0.0, self.guild.id)
+        else:
+            self.discard_prepared()
+            data = await self.resolve(next_item)
+            metrics.observe('prefetch_wait_seconds', time.perf_counter() - picked_at, self.guild.id)
+            if not data:
+                print(f'Could not resolve {next_item.url}, skipping.')
+                metrics.increment('tracks_skipped', self.guild.id)
+                self._starting = None
+                self.journal('remove', index = 0)
+                return await self.play_next()
+            player = build_player(data, self.volume, next_item.start_at)
+
+        # the queue entry the source is playing, for journal snapshots
+        player.entry = next_item
+        self.current = player
+        # journaled only now, so a snapshot taken in place of these records already has this track as current
+        self._starting = None
+        self.journal('play', position = next_item.start_at)
+        if voice_client.channel and voice_client.channel.id != self._journaled_channel:
+            self._journaled_channel = voice_client.channel.id
+            self.journal('channel', value = self._journaled_channel)
+        player.on_start = lambda started_at: self._record_start(player, picked_at, started_at)
+        metrics.increment('tracks_started', self.guild.id)
 
         def after_playback(err):
-            if err:
-                print(f'Playback error: {err}')
-            # schedule next track
-            asyncio.run_coroutine_threadsafe(self.play_next(guild), self.bot.loop)
+            self._ended_at = time.perf_counter()
+            # schedule next track (or a retry of this one)
+            asyncio.run_coroutine_threadsafe(self._after_playback(next_item, err), self.bot.loop)
 
         voice_client.play(player, after=after_playback)
+        # a resumed track only has what's left of it to play
+        duration = player.data.get('duration')
+        self.schedule_prewarm(duration - next_item.start_at if duration else duration)
+        # keep the tracks coming up next resolving
+        self.fill_lookahead()
+
+        # tracks that keep getting played get a local copy for next time; a retry is the same play again
+        video_id = get_cache_key(next_item.url)
+        if audio_cache and not next_item.retries:
+            served = audio_cache.record_play(video_id, bool(player.data.get('local_path')))
+            if served is None:
+                metrics.increment('audio_cache_misses', self.guild.id)
+            else:
+                metrics.increment('audio_cache_hits', self.guild.id)
+                metrics.increment('audio_cache_bytes_served', self.guild.id, served)
+            if audio_cache.wants(video_id):
+                cache_audio(next_item.url, video_id)
+
+        # a retry keeps quiet, the track was already announced
+        if next_item.retries:
+            return
 
         # send the now_playing message
-        channel = self.bot.get_channel(int(now_playing_channel_id))
-        if channel is None:
-            try:
-                channel = await self.bot.fetch_channel(int(now_playing_channel_id))
-            except Exception as e:
-                print(f'Error fetching now playing channel: {e}')
-                return
-
         channel_name = player.data.get('uploader', 'Unknown channel')
         webpage_url = player.data.get('webpage_url', 'Unknown URL')
+        description = f'Channel: {channel_name}\nLink: {webpage_url}'
+        if self.queue:
+            description += f'\nUp next: {self.queue[0].display_title}'
 
         response_embed = create_embed(
             title = player.title or 'Unknown Title',
-            description = f'Channel: {channel_name}\nLink: {webpage_url}',
+            description = description,
             colour = discord.Colour.from_rgb(0, 176, 244),
             timestamp = datetime.now(),
             author_name = f'Now playing',
@@ -225,23 +645,332 @@ class Music(commands.Cog):
             footer_url = 'https://niilun.dev/images/amoxliatl.png'
         )
 
-        if isinstance(channel, discord.TextChannel):
-            await channel.send(embed = response_embed)
+        # edits the last now playing message if nothing was posted since, and tells the requester
+        self.announcer.now_playing(response_embed, next_item.followup)
+
+    async def _after_playback(self, entry: QueueEntry, err):
+        # whichever source is playing entry now, a volume change may have swapped in another since play_next; None if skipped
+        player = self.current if self.current is not None and self.current.entry is entry else None
+        # a respawned source starts where the one before it was, so audio already went out even if it produced none
+        silent = player is not None and player.frames == 0 and player.start_at <= entry.start_at
+        if err:
+            print(f'Playback error: {err}')
+            metrics.increment('playback_errors', self.guild.id)
+        elif silent:
+            metrics.increment('stream_failures', self.guild.id)
+
+        # a track that never produced audio (usually a stale or ip-bound stream url) is retried with a fresh one
+        failed = err is not None or silent
+        if failed and player is not None and entry.retries < stream_retries and not self._closed:
+            print(f'Stream for {entry.url} failed to start, re-extracting.')
+            retry = entry.retry()
+            self.queue.appendleft(retry)
+            self.journal('appendleft', entry = retry.to_dict())
+
+        self.current = None
+        await self.play_next()
+
+    def _record_start(self, player, picked_at: float, started_at: float):
+        # runs on the voice thread when the first frame of player goes out
+        guild_id = self.guild.id
+        metrics.observe('time_to_first_audio_seconds', started_at - picked_at, guild_id)
+        source = player.original
+        if source.first_frame_at is not None:
+            metrics.observe('first_packet_seconds', source.first_frame_at - source.spawned_at, guild_id)
+
+        ended_at, self._ended_at = self._ended_at, None
+        if ended_at is not None:
+            metrics.observe('transition_gap_seconds', started_at - ended_at, guild_id)
+
+    # gapless playback
+
+    def schedule_prewarm(self, duration: float):
+        '''Arranges for the next track to be prepared shortly before the current one (of duration seconds) ends.'''
+        if self._prewarm_task and not self._prewarm_task.done():
+            self._prewarm_task.cancel()
+        self._prewarm_task = None
+        if gapless_playback and duration:
+            self._prewarm_task = asyncio.create_task(self._prewarm(max(0, duration - gapless_prewarm)))
+
+    async def _prewarm(self, delay: float):
+        await asyncio.sleep(delay)
+        if not self.queue or self._closed:
+            return
+        entry = self.queue[0]
+        if self.prepared and self.prepared[0] is entry:
+            return
+
+        data = await self.resolve(entry)
+        # the queue may have moved on while we resolved
+        if not data or not self.queue or self.queue[0] is not entry:
+            return
+
+        def prepare():
+            player = build_player(data, self.volume, entry.start_at)
+            player.original.prebuffer(gapless_prebuffer_frames)
+            return player
 
-        # notify interaction user if possible
         try:
-            await interaction.followup.send(content=None, embed=response_embed, ephemeral=True)
-        except discord.errors.InteractionResponded:
-            pass
+            player = await asyncio.get_running_loop().run_in_executor(None, prepare)
         except Exception as e:
-            print(f'Error sending interaction follow-up: {e}')
+            print(f'Failed to prepare next track: {e}')
+            return
 
-        # prefetch next track if possible
-        if self.queue:
-            next = self.queue[0]
-            if not next.get('prefetch'):
-                next['prefetch'] = asyncio.create_task(self.prefetch(next['url']))
+        if self.queue and self.queue[0] is entry and not self._closed:
+            self.discard_prepared()
+            self.prepared = (entry, player)
+        else:
+            player.cleanup()
+
+    def discard_prepared(self):
+        '''Throws away a prepared next track, e.g. because the queue changed.'''
+        if self.prepared:
+            self.prepared[1].cleanup()
+            self.prepared = None
+
+    # stream url refresh
+    def start_refresher(self):
+        if self._refresh_task is None or self._refresh_task.done():
+            self._refresh_task = asyncio.create_task(self._refresh_loop())
+
+    async def _refresh_loop(self):
+        while self.queue or self.is_playing:
+            await asyncio.sleep(stream_refresh_interval)
+            for entry in self.queue.head(stream_refresh_depth):
+                # None until the prefetch finished, and for failed ones, which play_next resolves again anyway
+                data = entry.data
+                if data and needs_refresh(data, stream_expiry_margin + stream_refresh_interval):
+                    entry.prefetch = asyncio.create_task(self.music.prefetch(entry.url, group = self.guild.id, refresh = True))
+
+    def skip(self):
+        '''Stops the current track; the after callback moves on to the next one.'''
+        voice_client = self.guild.voice_client
+        self.current = None
+        if not self.queue:
+            self.is_playing = False
+        if voice_client:
+            voice_client.stop()
+
+    async def stop(self):
+        '''Clears the queue and disconnects from voice.'''
+        self.clear()
+        self.is_playing = False
+        self.current = None
+        voice_client = self.guild.voice_client
+        if voice_client and voice_client.is_connected():
+            await voice_client.disconnect()
+        self.voice_client = None
+        # stopped on purpose, nothing to resume
+        if queue_journal:
+            queue_journal.discard(self.guild.id)
+
+    async def set_volume(self, volume: float):
+        '''Sets the volume for the current track and the ones after it.'''
+        self.volume = volume
+        self.journal('volume', value = volume)
+        voice_client = self.guild.voice_client
+        if not voice_client or not voice_client.source:
+            return
+
+        source = voice_client.source
+        if not isinstance(source, YTDLOpusSource):
+            source.volume = volume
+        elif source.volume != volume and voice_client.is_playing():
+            await self._respawn(source)
+
+    async def _respawn(self, source: YTDLOpusSource):
+        '''Replaces a playing opus source with one at the current volume, from the same position.'''
+        loop = asyncio.get_running_loop()
+        data = source.data
+        # late in a long track the stream url may have expired since it started
+        if not data.get('local_path') and needs_refresh(data, stream_expiry_margin) and source.entry:
+            data = await self.music.prefetch(source.entry.url, priority = PRIORITY_PLAYBACK, group = self.guild.id, refresh = True) or data
+        try:
+            player = await loop.run_in_executor(None, build_player, data, self.volume, source.position)
+        except Exception as e:
+            print(f'Failed to respawn FFmpeg for volume change: {e}')
+            return
+
+        voice_client = self.guild.voice_client
+        # the track may have ended or been skipped in the meantime
+        if not voice_client or voice_client.source is not source or not voice_client.is_playing():
+            player.cleanup()
+            return
+
+        player.entry = source.entry
+        voice_client.source = player
+        if self.current is source:
+            self.current = player
+        source.cleanup()
+
+    # idle teardown
+    def schedule_idle(self):
+        '''Starts the countdown to tearing this player down if nothing is queued.'''
+        if self._idle_task is None or self._idle_task.done():
+            self._idle_task = asyncio.create_task(self._idle_timeout())
+
+    def cancel_idle(self):
+        if self._idle_task and not self._idle_task.done():
+            self._idle_task.cancel()
+        self._idle_task = None
+
+    async def _idle_timeout(self):
+        await asyncio.sleep(idle_timeout)
+        if self.is_playing or self.queue:
+            return
+        self._idle_task = None
+        await self.stop()
+        if self.music.players.get(self.guild.id) is self:
+            self.music.remove_player(self.guild.id)
+
+    def cleanup(self):
+        '''Releases everything this player owns without touching the voice connection.'''
+        self._closed = True
+        self.cancel_idle()
+        for task in (self._refresh_task, self._prewarm_task):
+            if task and not task.done():
+                task.cancel()
+        self.clear()
+        self.is_playing = False
+        self.voice_client = None
+        # still sends what was already announced, e.g. the stop message
+        self.announcer.close()
+
+class Music(commands.Cog):
+    def __init__(self, bot):
+        self.bot = bot
+        self.players = {}
+        self.resolver = resolver
+        # the now playing channel, looked up once and shared by every guild's announcer
+        self._announce_channel = None
+        self._warm_up_task = None
+        self._checkpoint_task = None
+
+    async def cog_load(self):
+        # the caches load lazily, this only starts write-behind and expiry in the background
+        self.resolver.start()
+        if audio_cache:
+            asyncio.create_task(audio_cache.load())
+        if metrics_server:
+            await metrics_server.start()
+        if watchdog:
+            watchdog.start()
+        if queue_journal:
+            queue_journal.start()
+            self._checkpoint_task = asyncio.create_task(self._checkpoint_loop())
+
+    async def cog_unload(self):
+        if self._warm_up_task and not self._warm_up_task.done():
+            self._warm_up_task.cancel()
+        if queue_journal:
+            # where every guild is right now, then stop recording so tearing the players down isn't journaled
+            self._checkpoint_task.cancel()
+            for player in self.players.values():
+                player.checkpoint()
+            await queue_journal.close()
+        for player in list(self.players.values()):
+            player.cleanup()
+        self.players.clear()
+        await self.resolver.close()
+        if metrics_server:
+            await metrics_server.close()
+        if watchdog:
+            watchdog.stop()
+        scheduler.shutdown()
+        extractor.shutdown()
+        if audio_cache:
+            download_scheduler.shutdown()
+            download_pool.shutdown()
+
+    async def announce_channel(self):
+        '''Returns the now playing channel, fetching it only the first time.'''
+        if self._announce_channel is None:
+            channel = self.bot.get_channel(int(now_playing_channel_id))
+            if channel is None:
+                try:
+                    channel = await self.bot.fetch_channel(int(now_playing_channel_id))
+                except Exception as e:
+                    print(f'Error fetching now playing channel: {e}')
+                    return None
+            self._announce_channel = channel
+        return self._announce_channel
+
+    def get_player(self, guild: discord.Guild) -> GuildPlayer:
+        '''Returns the player for a guild, creating it on first use.'''
+        player = self.players.get(guild.id)
+        if player is None:
+            player = GuildPlayer(self, guild)
+            self.players[guild.id] = player
+        return player
+
+    def remove_player(self, guild_id: int):
+        '''Tears down the player for a guild, if there is one.'''
+        player = self.players.pop(guild_id, None)
+        if player:
+            player.cleanup()
+
+    @commands.Cog.listener()
+    async def on_ready(self):
+        # after login rather than in cog_load, so none of this delays connecting; on_ready repeats after reconnects
+        if self._warm_up_task is None:
+            self._warm_up_task = asyncio.create_task(self.warm_up())
+
+    async def warm_up(self):
+        '''Opens the caches and starts the extractor workers in the background.'''
+        started = time.perf_counter()
+        await self.resolver.warm_up()
+        # resuming goes first, its extractions start the workers anyway
+        if queue_journal:
+            await self.restore()
+        # with the daemon connected it does the extracting, local workers only start if we ever fall back
+        if resolver is local_resolver or not resolver.connected:
+            await extractor.warm_up()
+        print(f'Caches and extractor warmed up in {time.perf_counter() - started:.2f}s')
+
+    async def restore(self):
+        '''Rejoins voice and resumes every queue journaled before the last restart.'''
+        states = await queue_journal.load()
+        for guild_id, state in states.items():
+            guild = self.bot.get_guild(guild_id)
+            if guild is None:
+                # on another shard, or we left the guild; either way not ours to touch
+                continue
+            channel = guild.get_channel(state['channel']) if state.get('channel') else None
+            if channel is None or not (state['current'] or state['queue']):
+                queue_journal.discard(guild_id)
+                continue
 
+            try:
+                voice_client = guild.voice_client or await channel.connect()
+            except Exception as e:
+                print(f'Could not rejoin {channel.name} in {guild.name}: {e}')
+                continue
+
+            player = self.get_player(guild)
+            player.voice_client = voice_client
+            player.restore(state)
+            player.start()
+            print(f'Resumed {len(player.queue)} songs in {guild.name}')
+
+    async def _checkpoint_loop(self):
+        while True:
+            await asyncio.sleep(queue_journal_checkpoint_interval)
+            for player in self.players.values():
+                player.checkpoint()
+
+    @commands.Cog.listener()
+    async def on_voice_state_update(self, member: discord.Member, before: discord.VoiceState, after: discord.VoiceState):
+        # drop the player if the bot gets disconnected from voice
+        if member.id == self.bot.user.id and before.channel and after.channel is None:
+            self.remove_player(member.guild.id)
+            # kicked or moved out by someone, don't bring the queue back after a restart
+            if queue_journal:
+                queue_journal.discard(member.guild.id)
+
+    # song prefetch
+    async def prefetch(self, url: str, priority: int = PRIORITY_PREFETCH, group = None, refresh: bool = False):
+        '''Prefetches info for the next song in queue'''
+        return await resolver.resolve(url, priority = priority, group = group, refresh = refresh)
 
     @app_commands.command(name = 'join', description = 'Joins a selected channel.')
     async def join(self, interaction: discord.Interaction, *, channel: discord.VoiceChannel):
@@ -258,48 +987,108 @@ class Music(commands.Cog):
             await interaction.response.send_message(f'Error: {e}')
             print(f'Error in {__name__}: {e}')
 
+    async def join_requester(self, interaction: discord.Interaction):
+        '''Connects to the requester's voice channel if needed and returns the guild player, or None if they aren't in one.'''
+        # ensure user is in a voice channel
+        if not interaction.user.voice or not interaction.user.voice.channel:
+            await interaction.response.send_message('You are not connected to a voice channel.', ephemeral=True)
+            return None
+
+        voice_client = interaction.guild.voice_client
+        if not voice_client:
+            # connect to the user's voice channel
+            channel = interaction.user.voice.channel
+            voice_client = await channel.connect()
+
+        player = self.get_player(interaction.guild)
+        player.voice_client = voice_client
+        return player
+
     @app_commands.command(name='play_youtube', description='Plays audio from a YouTube URL')
     async def play_youtube(self, interaction: discord.Interaction, url: str):
         '''Slash command to play audio from a YouTube URL.'''
 
         # sanitize input
-        valid_domains = ['youtube.com', 'youtu.be', 'music.youtube.com']
-        if not any(domain in url for domain in valid_domains):
+        if not is_youtube_url(url):
             await interaction.response.send_message('This is not a valid URL.', ephemeral=True)
             return
 
-        # ensure user is in a voice channel
-        if not interaction.user.voice or not interaction.user.voice.channel:
-            await interaction.response.send_message('You are not connected to a voice channel.', ephemeral=True)
+        player = await self.join_requester(interaction)
+        if player is None:
             return
 
-        voice_client = interaction.guild.voice_client
-        if not voice_client:
-            # connect to the user's voice channel
-            channel = interaction.user.voice.channel
-            voice_client = await channel.connect()
+        # defer early so as to not hit the limit
+        await interaction.response.defer(thinking=True, ephemeral=True)
 
-        self.current_voice_client = voice_client
+        await self.queue_url(interaction, url, player)
+
+    @app_commands.command(name = 'play', description = 'Plays a YouTube URL or the top search result')
+    @app_commands.describe(query = 'A YouTube URL, or what to search YouTube for')
+    async def play(self, interaction: discord.Interaction, query: str):
+        '''Slash command to play a YouTube URL or search result.'''
+        query = query.strip()
+        if not query:
+            await interaction.response.send_message('Tell me what to play.', ephemeral=True)
+            return
+
+        player = await self.join_requester(interaction)
+        if player is None:
+            return
 
         # defer early so as to not hit the limit
         await interaction.response.defer(thinking=True, ephemeral=True)
 
-        # create a prefetch task
-        prefetch_task = asyncio.create_task(self.prefetch(url))
+        # picking an autocomplete suggestion hands us its url
+        if is_youtube_url(query):
+            await self.queue_url(interaction, query, player)
+            return
 
-        # add all the info to the queue
-        self.queue.append({'url': url, 'prefetch': prefetch_task, 'interaction': interaction})
+        # nothing playing means someone is waiting on silence, so the search jumps the prefetch queue
+        priority = PRIORITY_PREFETCH if player.is_playing else PRIORITY_PLAYBACK
+        try:
+            results = await asyncio.wait_for(searcher.search(query, priority = priority), timeout=15)
+        except asyncio.TimeoutError:
+            await interaction.followup.send('Timeout while searching.', ephemeral=True)
+            return
+        except Exception as e:
+            await interaction.followup.send(f'Error searching: {e}', ephemeral=True)
+            return
+
+        if not results:
+            await interaction.followup.send(f'No results for {query}.', ephemeral=True)
+            return
+        await self.queue_url(interaction, results[0]['url'], player, title = results[0]['title'])
+
+    @play.autocomplete('query')
+    async def play_autocomplete(self, interaction: discord.Interaction, current: str):
+        if is_youtube_url(current):
+            return []
+        results = await searcher.suggest(current, interaction.user.id, priority = PRIORITY_PREFETCH)
+        # discord takes at most 25 choices, with names of at most 100 characters
+        return [
+            app_commands.Choice(name = result['title'][:100], value = result['url'])
+            for result in results[:25] if result['title']
+        ]
+
+    async def queue_url(self, interaction: discord.Interaction, url: str, player: GuildPlayer, title: str = None):
+        '''Queues url (or imports it, if it's a playlist) for an already deferred interaction.'''
+        # a playlist link without a video in it gets imported whole
+        if get_playlist_id(url) and not get_cache_key(url):
+            await self.import_playlist(interaction, url, player)
+            return
+
+        # add all the info to the queue, this also starts prefetching it if it's close to the front
+        position = player.enqueue(url, interaction, title = title)
 
         # if nothing is playing, start playback
-        if not self.is_playing:
-            self.is_playing = True
-            asyncio.create_task(self.play_next(interaction.guild))
+        if player.start():
             await interaction.followup.send('Starting playback...', ephemeral=True)
             return
 
         # if player is active, fetch info and send message informing queue added
         try:
-            song_info = await asyncio.wait_for(YTDLSource.get_info(url, loop=asyncio.get_running_loop()), timeout=15)
+            # cached metadata is enough for the embed, only extract when we have none
+            song_info = await resolver.get_metadata(url) or await asyncio.wait_for(YTDLSource.get_info(url, loop=asyncio.get_running_loop(), group=interaction.guild.id), timeout=15)
             song_name = song_info.get('title', 'Unknown title')
             song_channel = song_info.get('uploader', 'Unknown channel')
             song_url = song_info.get('webpage_url', url)
@@ -322,13 +1111,133 @@ class Music(commands.Cog):
         )
 
         # Send ephemeral follow-up to the user
-        await interaction.followup.send(f'Added to queue, yours is #{len(self.queue)}', ephemeral=True)
+        await interaction.followup.send(f'Added to queue, yours is #{position}', ephemeral=True)
+
+        # Send embed to now playing channel, along with anything else queued in the next few seconds
+        player.announcer.queued(response_embed, f'{song_name} ({interaction.user.display_name})')
+
+    @app_commands.command(name = 'play_many', description = 'Queues several YouTube URLs at once')
+    @app_commands.describe(urls = 'YouTube URLs separated by spaces, commas or new lines')
+    async def play_many(self, interaction: discord.Interaction, urls: str):
+        '''Slash command to queue many YouTube URLs in one go.'''
+
+        # sanitize input
+        url_list = [url for url in re.split(r'[\s,]+', urls) if url]
+        valid_urls = [url for url in url_list if is_youtube_url(url)]
+        if not valid_urls:
+            await interaction.response.send_message('None of these are valid URLs.', ephemeral=True)
+            return
+        if len(valid_urls) > bulk_enqueue_limit:
+            await interaction.response.send_message(f'You can queue up to {bulk_enqueue_limit} URLs at once.', ephemeral=True)
+            return
+
+        player = await self.join_requester(interaction)
+        if player is None:
+            return
+
+        # defer early so as to not hit the limit
+        await interaction.response.defer(thinking=True, ephemeral=True)
+
+        # songs go into the queue in order as they resolve, so the first one can start while the rest are still going
+        added = 0
+        failed = len(url_list) - len(valid_urls)
+        # a /stop or /clear while we resolve means the rest isn't wanted anymore
+        generation = player.generation
+        interrupted = False
+        results = player.resolve_many(valid_urls)
+        try:
+            async for url, data in results:
+                if player._closed or player.generation != generation:
+                    interrupted = True
+                    break
+                if not data:
+                    failed += 1
+                    continue
+                player.enqueue(url, interaction, data = data)
+                added += 1
+                if player.start():
+                    await interaction.followup.send('Starting playback...', ephemeral=True)
+        finally:
+            # cancels the resolves still running
+            await results.aclose()
+
+        if interrupted:
+            await interaction.followup.send(f'The queue was cleared, stopped after adding {added} songs.', ephemeral=True)
+            return
+
+        message = f'Added {added} songs to the queue.'
+        if failed:
+            message += f' {failed} could not be added.'
+        await interaction.followup.send(message, ephemeral=True)
+
+        response_embed = create_embed(
+            title = f'{added} songs added to queue',
+            colour = discord.Colour.from_rgb(0, 176, 244),
+            timestamp = datetime.now(),
+            author_name = f'{interaction.user.display_name} added to queue',
+            author_url = interaction.user.display_avatar.url,
+            footer_name = f'Amoxliatl v{version}',
+            footer_url = 'https://niilun.dev/images/amoxliatl.png'
+        )
 
         # Send embed to now playing channel
-        channel = self.bot.get_channel(int(now_playing_channel_id))
-        if channel is None:
-            channel = await self.bot.fetch_channel(int(now_playing_channel_id))
-        await channel.send(content=None, embed=response_embed)
+        if added:
+            player.announcer.send(response_embed)
+
+    @app_commands.command(name = 'play_playlist', description = 'Queues a YouTube playlist or mix')
+    async def play_playlist(self, interaction: discord.Interaction, url: str):
+        '''Slash command to queue every song in a YouTube playlist or mix.'''
+
+        # sanitize input
+        if not is_youtube_url(url) or not get_playlist_id(url):
+            await interaction.response.send_message('This is not a valid playlist URL.', ephemeral=True)
+            return
+
+        player = await self.join_requester(interaction)
+        if player is None:
+            return
+
+        # defer early so as to not hit the limit
+        await interaction.response.defer(thinking=True, ephemeral=True)
+
+        await self.import_playlist(interaction, url, player)
+
+    async def import_playlist(self, interaction: discord.Interaction, url: str, player: GuildPlayer):
+        '''Streams a playlist into the guild queue, starting playback as soon as the first page is in.'''
+        added = 0
+        playlist_title = None
+        try:
+            async for playlist_title, entries in player.iter_playlist(url):
+                for entry in entries:
+                    player.enqueue(entry['url'], interaction, title = entry['title'])
+                added += len(entries)
+                if entries and player.start():
+                    await interaction.followup.send('Starting playback, the rest of the playlist is loading...', ephemeral=True)
+        except Exception as e:
+            print(f'Playlist import failed for {url}: {e}')
+            await interaction.followup.send(f'Error importing playlist: {e}', ephemeral=True)
+            if not added:
+                return
+
+        if not added:
+            await interaction.followup.send('Could not find any songs in that playlist.', ephemeral=True)
+            return
+
+        await interaction.followup.send(f'Added {added} songs to the queue.', ephemeral=True)
+
+        response_embed = create_embed(
+            title = playlist_title or 'Playlist',
+            description = f'{added} songs\nLink: {url}',
+            colour = discord.Colour.from_rgb(0, 176, 244),
+            timestamp = datetime.now(),
+            author_name = f'{interaction.user.display_name} added a playlist to queue',
+            author_url = interaction.user.display_avatar.url,
+            footer_name = f'Amoxliatl v{version}',
+            footer_url = 'https://niilun.dev/images/amoxliatl.png'
+        )
+
+        # Send embed to now playing channel
+        player.announcer.send(response_embed)
 
     @app_commands.command(name = 'skip', description = 'Skips current song')
     async def skip(self, interaction: discord.Interaction):
@@ -336,15 +1245,13 @@ class Music(commands.Cog):
         await interaction.response.defer(thinking = True, ephemeral = True)
 
         voice_client = interaction.guild.voice_client
-        channel = self.bot.get_channel(int(now_playing_channel_id))
-        if channel is None:
-            channel = await self.bot.fetch_channel(int(now_playing_channel_id))
-        
+        player = self.get_player(interaction.guild)
+
         if not voice_client or not voice_client.is_playing():
             await interaction.followup.send('Nothing is currently playing.', ephemeral = True)
             return
 
-        if self.queue:
+        if player.queue:
             # build an embed announcing who skipped the current song
             await interaction.followup.send('Skipped to next song.', ephemeral = True)
             current_title = 'Unknown Title'
@@ -363,13 +1270,11 @@ class Music(commands.Cog):
                 footer_url = 'https://niilun.dev/images/amoxliatl.png',
             )
 
-            voice_client.stop()
-            if isinstance(channel, discord.TextChannel):
-                await channel.send(content = None, embed = response_embed)
+            player.skip()
+            player.announcer.send(response_embed)
         else:
             await interaction.followup.send('Skipped and stopped playback.', ephemeral = True)
-            voice_client.stop()
-            self.is_playing = False
+            player.skip()
 
             response_embed = create_embed(
                 title = 'Stopped playback. No more songs in the queue.',
@@ -381,9 +1286,8 @@ class Music(commands.Cog):
                 footer_url = 'https://niilun.dev/images/amoxliatl.png',
             )
 
-            if isinstance(channel, discord.TextChannel):
-                await channel.send(content = None, embed = response_embed)
-        
+            player.announcer.send(response_embed)
+
     @app_commands.command(name = 'volume', description = 'Changes player volume')
     async def volume(self, interaction: discord.Interaction, volume: int):
         '''Changes the player's volume'''
@@ -397,13 +1301,15 @@ class Music(commands.Cog):
             await interaction.response.send_message('Nothing is playing.', ephemeral = True)
             return
 
-        voice_client.source.volume = volume / 100
+        await self.get_player(interaction.guild).set_volume(volume / 100)
         await interaction.response.send_message(f'Changed volume to {volume}%', ephemeral = True)
 
     @app_commands.command(name = 'queue', description = 'Shows the current queue')
-    async def show_queue(self, interaction: discord.Interaction):
-        '''Shows the current queue for the interaction\'s guild.'''
-        if not self.queue:
+    async def show_queue(self, interaction: discord.Interaction, page: int = 1):
+        '''Shows a page of the current queue for the interaction\'s guild.'''
+        # don't create a player just to say the queue is empty
+        player = self.players.get(interaction.guild.id)
+        if not player or not player.queue:
             response_embed = create_embed(
                 title = 'The queue is empty.',
                 colour = discord.Colour.from_rgb(0, 176, 244),
@@ -413,19 +1319,26 @@ class Music(commands.Cog):
                 footer_name = f'Amoxliatl v{version}',
                 footer_url = 'https://niilun.dev/images/amoxliatl.png',
             )
-            
+
             await interaction.response.send_message(content = None, embed = response_embed, ephemeral = True)
             return
 
+        pages = (len(player.queue) + queue_page_size - 1) // queue_page_size
+        page = min(max(page, 1), pages)
+
+        # only the visible page gets rendered, entries may not have a title yet so fall back to the url
         queue_list = []
-        for idcount, item in enumerate(self.queue, start = 1):
-            # queue items may not have a name, so try getting name -> title -> url in that order
-            display_name = item.get('name') or item.get('title') or item.get('url')
-            item_url = item.get('url') or display_name
-            queue_list.append(f'{idcount}. {item_url}')
+        start = (page - 1) * queue_page_size
+        for idcount, entry in enumerate(player.queue.page(page - 1, queue_page_size), start = start + 1):
+            if not entry.title and not entry.data:
+                # fill in titles we already know without extracting anything
+                metadata = await resolver.get_metadata(entry.url)
+                if metadata:
+                    entry.title = metadata.get('title')
+            queue_list.append(f'{idcount}. {entry.display_title}')
 
         response_embed = create_embed(
-            title = f'Current queue for {interaction.guild.name}',
+            title = f'Current queue for {interaction.guild.name} (page {page}/{pages}, {len(player.queue)} songs)',
             description = '\n'.join(queue_list),
             colour = discord.Colour.from_rgb(0, 176, 244),
             timestamp = datetime.now(),
@@ -437,19 +1350,44 @@ class Music(commands.Cog):
 
         await interaction.response.send_message(content = None, embed = response_embed, ephemeral = True)
 
+    @app_commands.command(name = 'remove', description = 'Removes a song from the queue')
+    async def remove(self, interaction: discord.Interaction, position: int):
+        '''Removes the song at a queue position.'''
+        player = self.players.get(interaction.guild.id)
+        if not player or not 1 <= position <= len(player.queue):
+            await interaction.response.send_message('There is no song at that position.', ephemeral = True)
+            return
+
+        entry = player.remove(position - 1)
+        await interaction.response.send_message(f'Removed #{position}: {entry.display_title}', ephemeral = True)
+
+    @app_commands.command(name = 'move', description = 'Moves a song to another position in the queue')
+    async def move(self, interaction: discord.Interaction, position: int, new_position: int):
+        '''Moves the song at a queue position to another one.'''
+        player = self.players.get(interaction.guild.id)
+        if not player or not 1 <= position <= len(player.queue) or not 1 <= new_position <= len(player.queue):
+            await interaction.response.send_message('There is no song at that position.', ephemeral = True)
+            return
+
+        entry = player.move(position - 1, new_position - 1)
+        await interaction.response.send_message(f'Moved {entry.display_title} to #{new_position}', ephemeral = True)
+
+    @app_commands.command(name = 'shuffle', description = 'Shuffles the queue')
+    async def shuffle(self, interaction: discord.Interaction):
+        '''Shuffles the queue.'''
+        player = self.players.get(interaction.guild.id)
+        if not player or len(player.queue) < 2:
+            await interaction.response.send_message('There is nothing to shuffle.', ephemeral = True)
+            return
+
+        player.shuffle()
+        await interaction.response.send_message(f'Shuffled {len(player.queue)} songs.', ephemeral = True)
+
     @app_commands.command(name = 'stop', description = 'Stops playback and clears the queue.')
     async def stop(self, interaction: discord.Interaction):
         '''Stops and disconnects the bot from voice.'''
 
         voice_client = interaction.guild.voice_client
-        channel = self.bot.get_channel(int(now_playing_channel_id))
-        if channel is None:
-            try:
-                channel = await self.bot.fetch_channel(int(now_playing_channel_id))
-            except Exception as e:
-                print(f'Error fetching now playing channel: {e}')
-                return
-        
         channel_name = interaction.guild.voice_client.channel.name if interaction.guild.voice_client and interaction.guild.voice_client.channel else 'Unknown'
 
         response_embed = create_embed(
@@ -462,13 +1400,81 @@ class Music(commands.Cog):
             footer_name = None,
             footer_url = None
         )
-        
+
         if voice_client and voice_client.is_connected():
-            self.queue.clear()
-            self.is_playing = False
-            await voice_client.disconnect()
+            player = self.get_player(interaction.guild)
+            # queued before disconnecting: the disconnect's voice state update removes the player, and a closed announcer only delivers what it already had
+            player.announcer.send(response_embed)
+            await player.stop()
+            self.remove_player(interaction.guild.id)
             await interaction.response.send_message('Disconnected from the voice channel and cleared the queue.', ephemeral = True)
-            if isinstance(channel, discord.TextChannel):
-                await channel.send(content = None, embed = response_embed)
         else:
-            await interaction.response.send_message('Not connected to a voice channel.', ephemeral = True)
\ No newline at end of file
+            await interaction.response.send_message('Not connected to a voice channel.', ephemeral = True)
+
+    @app_commands.command(name = 'stats', description = 'Shows playback and extraction timings')
+    @app_commands.default_permissions(administrator = True)
+    @app_commands.guild_only()
+    async def stats(self, interaction: discord.Interaction):
+        '''Shows timing histograms for this guild and overall, plus cache and extractor counters.'''
+        def describe(summary: dict) -> str:
+            lines = []
+            for name, histogram in sorted(summary['histograms'].items()):
+                lines.append(
+                    f"{name.removesuffix('_seconds').replace('_', ' ')}: "
+                    f"p50 {histogram['p50'] * 1000:.0f} ms, p95 {histogram['p95'] * 1000:.0f} ms, "
+                    f"p99 {histogram['p99'] * 1000:.0f} ms (n={histogram['count']})"
+                )
+            if summary['counters']:
+                lines.append(', '.join(f"{name.replace('_', ' ')}: {count}" for name, count in sorted(summary['counters'].items())))
+            return '\n'.join(lines) or 'Nothing recorded yet.'
+
+        # asking the resolver daemon can take a while, more than Discord gives us to answer
+        await interaction.response.defer(thinking=True, ephemeral=True)
+
+        resolver_stats = resolver.stats()
+        description = (
+            f'**{interaction.guild.name}**\n{describe(metrics.summary(interaction.guild.id))}\n\n'
+            f'**All guilds**\n{describe(metrics.summary())}\n\n'
+            f"**Resolver**\nhits {resolver_stats['hits']}, joins {resolver_stats['joins']}, misses {resolver_stats['misses']}, "
+            f"failed {resolver_stats['negative_hits']}, queued {resolver_stats['queued']}, in flight {resolver_stats['inflight']}, "
+            f'extractor recycles {extractor.recycles}\n\n'
+            f'**Search**\ncached {searcher.hits}, from a prefix {searcher.prefix_hits}, searched {searcher.searches}'
+        )
+        if resolver is not local_resolver:
+            # the counters above only cover what fell back to this process
+            description += (
+                f"\n\n**Resolver daemon**\n{'connected' if resolver_stats['connected'] else 'not connected'}, "
+                f"{resolver_stats['remote_calls']} calls, {resolver_stats['fallbacks']} handled in-process"
+            )
+            daemon_stats = await resolver.remote_stats()
+            if daemon_stats:
+                description += (
+                    f"\nhits {daemon_stats['hits']}, joins {daemon_stats['joins']}, misses {daemon_stats['misses']}, "
+                    f"failed {daemon_stats['negative_hits']}, queued {daemon_stats['queued']}, in flight {daemon_stats['inflight']}, "
+                    f"{daemon_stats['clients']} bot processes connected"
+                )
+        if watchdog:
+            description += f'\n\n**Event loop**\n{watchdog.stalls} stalls over {watchdog.threshold * 1000:.0f} ms'
+            if watchdog.last_stall:
+                stalled, location = watchdog.last_stall
+                description += f', last one {stalled * 1000:.0f} ms at {location}'
+        if audio_cache:
+            cache_stats = audio_cache.stats()
+            description += (
+                f"\n\n**Audio cache**\n{cache_stats['files']} files, {cache_stats['bytes'] / 1048576:.1f} MiB, "
+                f"hit rate {cache_stats['hit_rate']:.0%}, {cache_stats['bytes_served'] / 1048576:.1f} MiB served locally"
+            )
+
+        response_embed = create_embed(
+            title = 'Playback stats',
+            # embed descriptions are capped at 4096 characters
+            description = description[:4096],
+            colour = discord.Colour.from_rgb(0, 176, 244),
+            timestamp = datetime.now(),
+            author_name = None,
+            author_url = None,
+            footer_name = f'Amoxliatl v{version}',
+            footer_url = 'https://niilun.dev/images/amoxliatl.png',
+        )
+
+        await interaction.followup.send(embed = response_embed, ephemeral = True)
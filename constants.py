@@ -3,8 +3,82 @@ import os
 
 load_dotenv()
 
-cache_file = 'prefetch_cache.json'
-cache_ttl = 10800 # time for cache data to be considered valid; in seconds.
+cache_file = 'prefetch_cache.db'
+cache_ttl = 10800 # longest time cache data is considered valid, stream urls that expire sooner are dropped earlier; in seconds.
+cache_max_entries = 2048 # entries kept in memory, the rest are read back from cache_file on demand
+metadata_ttl = 2592000 # how long titles, uploaders and durations are cached, separately from stream urls; in seconds.
+failure_ttl = 600 # how long a video that failed to extract is remembered as failed before it's tried again; in seconds.
+
+extractor_backend = os.getenv('EXTRACTOR_BACKEND', 'process') # 'process' keeps yt-dlp off the bot process, 'thread' runs it on threads like before
+extractor_workers = int(os.getenv('EXTRACTOR_WORKERS', '2'))
+extractor_timeout = 30 # time an extraction can take before its worker is considered hung and recycled; in seconds.
+extractor_max_tasks = 200 # extractions a worker process handles before it's replaced
+extractor_rate = 1.0 # extractions started per second on average, across all guilds
+extractor_burst = 3 # extractions that can start back to back before extractor_rate kicks in
+
+stream_expiry_margin = 300 # stream urls expiring within this are treated as stale and re-extracted; in seconds.
+stream_refresh_interval = 60 # how often queued tracks are checked for stream urls about to expire; in seconds.
+stream_refresh_depth = 2 # how many tracks from the front of the queue are kept fresh in the background
+stream_retries = 1 # times a track that fails to start is re-extracted and retried before it's skipped
+
+gapless_playback = os.getenv('GAPLESS_PLAYBACK', 'false').lower() == 'true' # start the next track's FFmpeg before the current one ends
+gapless_prewarm = 5 # how long before the current track ends the next one is started and buffered; in seconds.
+gapless_prebuffer_frames = 50 # 20 ms frames read ahead for the next track
+
+playback_mode = os.getenv('PLAYBACK_MODE', 'pcm') # 'opus' passes opus streams through without decoding, 'pcm' decodes everything and scales volume in Python
+
+lookahead_depth = 3 # upcoming queue entries kept resolved ahead of playback
+lookahead_concurrency = 2 # resolutions a single guild runs at once, for lookahead and bulk enqueues
+bulk_enqueue_limit = 25 # urls accepted by a single /play_many
+queue_page_size = 10 # songs shown per /queue page
+
+playlist_first_page = 10 # entries listed before playback starts on a playlist import
+playlist_page_size = 100 # entries listed per request after that
+playlist_import_limit = 500 # most entries taken from one playlist, mixes never end
+
+audio_cache_enabled = os.getenv('AUDIO_CACHE', 'false').lower() == 'true' # keep local copies of frequently replayed tracks
+audio_cache_dir = 'audio_cache'
+audio_cache_max_bytes = int(os.getenv('AUDIO_CACHE_MAX_MB', '2048')) * 1024 * 1024
+audio_cache_min_plays = 2 # plays a track needs before it gets downloaded
+audio_cache_download_timeout = 300 # in seconds.
+audio_cache_download_workers = 1 # downloads run on workers of their own, so a long one never holds up extraction for playback
+
+announce_batch_window = 2.0 # queue adds announced within this of each other are merged into one message; in seconds.
+
+metrics_host = os.getenv('METRICS_HOST', '127.0.0.1') # where the Prometheus endpoint listens, keep it local unless something in front of it handles access
+metrics_port = int(os.getenv('METRICS_PORT', '0')) # port for GET /metrics in the Prometheus text format, 0 disables it
+
+loop_watchdog = os.getenv('LOOP_WATCHDOG', 'false').lower() == 'true' # log the stack of whatever blocks the event loop, and record loop lag in the metrics
+loop_watchdog_threshold = 0.25 # how long the loop can go without running before it counts as blocked; in seconds.
+loop_watchdog_interval = 0.1 # how often the loop heartbeat runs; in seconds.
+
+gateway_mode = os.getenv('GATEWAY_MODE', 'full') # 'lean' connects with only the intents and caches the music commands need, sharded; 'full' uses every intent like before
+shard_count = int(os.getenv('SHARD_COUNT')) if os.getenv('SHARD_COUNT') else None # total shards across all processes, Discord's recommendation when unset
+shard_ids = os.getenv('SHARD_IDS') # shards this process runs, e.g. '0-3' or '0,2'; all of them when unset
+shard_processes = int(os.getenv('SHARD_PROCESSES', '1')) # local processes to split shard_count between, each gets a contiguous range
+
+command_hash_file = 'command_tree.hash' # hash of the last command tree synced with Discord, the tree only syncs again when it changes
+force_command_sync = os.getenv('FORCE_COMMAND_SYNC', 'false').lower() == 'true' # sync on startup even if the hash matches
+
+queue_journal_enabled = os.getenv('QUEUE_JOURNAL', 'false').lower() == 'true' # journal every guild's queue to disk and resume playback after a restart
+queue_journal_dir = 'queue_journal'
+queue_journal_compact_after = 500 # lines a guild's journal can grow to before it's rewritten as a single snapshot
+queue_journal_checkpoint_interval = 10 # how often the playback position is journaled, and so the most a resume can rewind; in seconds.
+queue_journal_max_age = 3600 # journals untouched for longer than this are dropped instead of resumed; in seconds.
+
+search_results = 5 # results per search, /play takes the top one and autocomplete lists them all
+search_cache_size = 1000 # searches kept in memory for autocomplete and /play
+search_cache_ttl = 3600 # how long search results are reused; in seconds.
+search_debounce = 0.4 # how long someone has to stop typing before autocomplete runs a real search; in seconds.
+search_budget = 2.0 # how long autocomplete waits on a search before answering with cached results, Discord gives up after 3; in seconds.
+search_min_length = 3 # queries shorter than this are only matched against cached titles
+
+resolver_address = os.getenv('RESOLVER_ADDRESS') # Unix socket path or host:port of the shared resolver daemon (resolver_daemon.py); unset to always extract in-process
+resolver_timeout = 120 # how long a call waits on the daemon before doing the work in-process instead; in seconds.
+resolver_retry_interval = 10 # how often to try reaching the daemon again after it went away; in seconds.
+resolver_ping_interval = 10 # how often the connection to the daemon is checked, a missed ping drops it and everything falls back; in seconds.
+
+idle_timeout = 300 # time a guild player can sit with nothing queued before it disconnects and is torn down; in seconds.
 
 version = '0.2.81'
 
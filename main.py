@@ -1,37 +1,171 @@
-import discord, asyncio, random
-from discord import app_commands
-from discord.ext import commands, tasks
-from dotenv import load_dotenv, dotenv_values
+import time
+# as close to process start as we can get, before the heavy imports
+started_at = time.perf_counter()
 
-from commands.voice import Music
+import asyncio, hashlib, json, random, os, signal, subprocess, sys
 
 from constants import version, token, statuses, twitch_user
+from constants import gateway_mode, shard_count, shard_ids, shard_processes, command_hash_file, force_command_sync
 
-intents = discord.Intents.all()
-bot = commands.Bot(command_prefix="!", intents=intents)
+def parse_shard_ids(text: str):
+    '''Turns '0-3,8' into [0, 1, 2, 3, 8].'''
+    ids = []
+    for part in text.split(','):
+        if '-' in part:
+            first, last = part.split('-')
+            ids.extend(range(int(first), int(last) + 1))
+        elif part.strip():
+            ids.append(int(part))
+    return ids
 
-print(f'Amoxliatl version {version}')
+# extractor workers are spawned processes that re-import this module, so discord, the cogs
+# and the bot itself are only loaded by load_bot() in the process that runs the bot
+bot = None
+metrics = None
+change_status = None
+
+def create_bot():
+    import discord
+    from discord.ext import commands
+
+    if gateway_mode != 'lean':
+        return commands.Bot(command_prefix="!", intents=discord.Intents.all())
+
+    # guilds for the guild and channel cache, voice states to know who is in which channel; interactions need no intent
+    intents = discord.Intents.none()
+    intents.guilds = True
+    intents.voice_states = True
+
+    # only keep members that are in a voice channel, nobody else is ever looked at
+    member_cache_flags = discord.MemberCacheFlags.none()
+    member_cache_flags.voice = True
+
+    return commands.AutoShardedBot(
+        command_prefix="!",
+        intents=intents,
+        member_cache_flags=member_cache_flags,
+        chunk_guilds_at_startup=False,
+        # announcements keep hold of the messages they edit, nothing else reads old messages
+        max_messages=None,
+        shard_count=shard_count,
+        shard_ids=parse_shard_ids(shard_ids) if shard_ids else None
+    )
+
+# the first ready and the first command, for reporting startup time
+ready_once = False
+command_once = False
+
+def command_tree_hash() -> str:
+    '''Hashes the command tree as it would be sent to Discord.'''
+    payload = sorted((command.to_dict(bot.tree) for command in bot.tree.get_commands()), key = lambda command: command['name'])
+    return hashlib.sha256(f'{bot.application_id}:{json.dumps(payload, sort_keys = True)}'.encode()).hexdigest()
+
+async def sync_commands():
+    '''Syncs the command tree, but only if it changed since the last sync.'''
+    tree_hash = command_tree_hash()
+    try:
+        with open(command_hash_file) as file:
+            synced_hash = file.read().strip()
+    except OSError:
+        synced_hash = None
+
+    if tree_hash == synced_hash and not force_command_sync:
+        print('Commands unchanged, skipping sync.')
+        return
 
-@bot.event
-async def on_ready():
-    print(f'Logged in as {bot.user}')
     try:
         synced = await bot.tree.sync()
         print(f'Synced {len(synced)} commands with Discord endpoints.')
     except Exception as e:
         print(f'Failed to sync commands, error {e}')
+        return
+    with open(command_hash_file, 'w') as file:
+        file.write(tree_hash)
+
+async def on_ready():
+    global ready_once
+    print(f'Logged in as {bot.user}')
+    # on_ready fires again after every reconnect, none of this needs repeating
+    if ready_once:
+        return
+    ready_once = True
+
+    ready_seconds = time.perf_counter() - started_at
+    metrics.observe('startup_ready_seconds', ready_seconds)
+    print(f'Ready {ready_seconds:.2f}s after start')
+
+    # every process sees the same global commands, so only the one running shard 0 syncs them
+    shards = getattr(bot, 'shard_ids', None)
+    if shards is None or 0 in shards:
+        await sync_commands()
     change_status.start()
 
-@tasks.loop(minutes=2)
-async def change_status():
+async def report_first_command(interaction: 'discord.Interaction'):
+    global command_once
+    if command_once or interaction.type != discord.InteractionType.application_command:
+        return
+    command_once = True
+    command_seconds = time.perf_counter() - started_at
+    metrics.observe('startup_first_command_seconds', command_seconds)
+    print(f'First command accepted {command_seconds:.2f}s after start')
+
+async def update_status():
     await bot.change_presence(activity=discord.Streaming(name = random.choice(statuses), url = f"https://twitch.tv/{twitch_user}"))
 
+def load_bot():
+    '''Imports discord and the cogs, creates the bot and registers its events.'''
+    global discord, bot, metrics, Music, change_status
+    import discord
+    from discord.ext import tasks
+    from commands.voice import Music, metrics
+
+    bot = create_bot()
+    bot.event(on_ready)
+    bot.add_listener(report_first_command, 'on_interaction')
+    change_status = tasks.loop(minutes=2)(update_status)
+
 async def setup_cogs():
     await bot.add_cog(Music(bot))
 
 async def main():
+    load_bot()
     async with bot:
+        # deploys stop us with SIGTERM, close properly so the cogs can save their state
+        try:
+            asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, lambda: asyncio.create_task(bot.close()))
+        except NotImplementedError:
+            # not available on Windows
+            pass
         await setup_cogs()
         await bot.start(token)
 
-asyncio.run(main())
\ No newline at end of file
+def launch_shard_processes():
+    '''Starts one child process per contiguous slice of shards and waits for them.'''
+    if gateway_mode != 'lean' or not shard_count:
+        print('SHARD_PROCESSES needs GATEWAY_MODE=lean and SHARD_COUNT.')
+        return
+
+    children = []
+    for index in range(shard_processes):
+        first = index * shard_count // shard_processes
+        last = (index + 1) * shard_count // shard_processes - 1
+        if last < first:
+            continue
+        env = {**os.environ, 'SHARD_IDS': f'{first}-{last}', 'SHARD_PROCESSES': '1'}
+        print(f'Starting shards {first}-{last} of {shard_count}')
+        children.append(subprocess.Popen([sys.executable, os.path.abspath(__file__)], env = env))
+
+    try:
+        for child in children:
+            child.wait()
+    except KeyboardInterrupt:
+        for child in children:
+            child.terminate()
+
+# extractor workers are spawned processes that import this module, so they must not start the bot
+if __name__ == '__main__':
+    print(f'Amoxliatl version {version}')
+    if shard_processes > 1:
+        launch_shard_processes()
+    else:
+        asyncio.run(main())
@@ -0,0 +1,39 @@
+import asyncio, signal
+
+from commands.voice import extractor, scheduler, local_resolver, shared_functions
+
+from constants import resolver_address
+from utilities.resolver_service import ResolverService
+
+async def main():
+    '''Owns the cache and extractor workers for every bot process on this host until stopped.'''
+    service = ResolverService(local_resolver, shared_functions, resolver_address)
+
+    local_resolver.start()
+    await local_resolver.warm_up()
+    await extractor.warm_up()
+    await service.start()
+
+    stopped = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(signum, stopped.set)
+        except NotImplementedError:
+            # not available on Windows
+            pass
+
+    try:
+        await stopped.wait()
+    finally:
+        await service.close()
+        await local_resolver.close()
+        scheduler.shutdown()
+        extractor.shutdown()
+
+# extractor workers are spawned processes that import this module, so they must not start the daemon
+if __name__ == '__main__':
+    if not resolver_address:
+        print('Set RESOLVER_ADDRESS to where the daemon should listen, e.g. /tmp/amoxliatl-resolver.sock')
+    else:
+        asyncio.run(main())
@@ -0,0 +1,127 @@
+import asyncio
+import discord
+
+from utilities.create_embed import create_embed
+
+class Announcer:
+    '''Sends a guild's announcements in the background, one at a time and in order.
+
+    Commands hand their embeds over and return straight away. Queue-add
+    notices arriving within batch_window of each other go out as a single
+    message, and a new now-playing embed edits the previous one when
+    nothing else was posted in between.
+    '''
+
+    def __init__(self, get_channel, batch_window: float = 2.0):
+        # coroutine function returning the channel to announce in, or None
+        self.get_channel = get_channel
+        self.batch_window = batch_window
+
+        self._queue = asyncio.Queue()
+        self._worker = None
+        # (embed, one-line summary) of queue adds waiting for the batch window to close
+        self._added = []
+        self._flush_handle = None
+        self._closed = False
+        # our last message in the channel, and whether it's the now-playing one
+        self._last = None
+        self._last_is_live = False
+
+        self.sent = 0
+        self.edited = 0
+        self.batched = 0
+
+    def _put(self, item):
+        if self._closed:
+            return
+        if self._worker is None:
+            self._worker = asyncio.create_task(self._run())
+        self._queue.put_nowait(item)
+
+    def send(self, embed):
+        '''Posts embed in the announcement channel.'''
+        self._put(('send', embed))
+
+    def now_playing(self, embed, followup = None):
+        '''Posts or updates the live now-playing message, and sends embed to the requester's followup if given.'''
+        self._put(('live', embed))
+        if followup is not None:
+            self._put(('followup', (followup, embed)))
+
+    def queued(self, embed, summary: str):
+        '''Announces a queue add, merged with any others that arrive within the batch window.'''
+        if self._closed:
+            return
+        self._added.append((embed, summary))
+        if self._flush_handle is None:
+            self._flush_handle = asyncio.get_running_loop().call_later(self.batch_window, self._flush_added)
+
+    def _flush_added(self):
+        self._flush_handle = None
+        added, self._added = self._added, []
+        if not added:
+            return
+        if len(added) == 1:
+            self._put(('send', added[0][0]))
+            return
+
+        self.batched += len(added) - 1
+        first = added[0][0]
+        description = '\n'.join(summary for _, summary in added)
+        embed = create_embed(
+            title = f'{len(added)} songs added to queue',
+            # embed descriptions are capped at 4096 characters
+            description = description[:4096],
+            colour = first.colour,
+            timestamp = first.timestamp,
+            footer_name = first.footer.text,
+            footer_url = first.footer.icon_url
+        )
+        self._put(('send', embed))
+
+    async def _run(self):
+        while True:
+            kind, payload = await self._queue.get()
+            if kind == 'close':
+                return
+            try:
+                await self._deliver(kind, payload)
+            except Exception as e:
+                print(f'Failed to send announcement: {e}')
+
+    async def _deliver(self, kind: str, payload):
+        if kind == 'followup':
+            followup, embed = payload
+            try:
+                await followup.send(content = None, embed = embed, ephemeral = True)
+            except discord.errors.InteractionResponded:
+                pass
+            return
+
+        channel = await self.get_channel()
+        if channel is None:
+            return
+
+        if kind == 'live' and self._last is not None and self._last_is_live:
+            try:
+                await self._last.edit(embed = payload)
+                self.edited += 1
+                return
+            except Exception:
+                # deleted or otherwise gone, post a new one instead
+                pass
+
+        self._last = await channel.send(content = None, embed = payload)
+        self._last_is_live = kind == 'live'
+        self.sent += 1
+
+    def close(self):
+        '''Sends whatever is still pending, then stops the worker.'''
+        if self._closed:
+            return
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+        self._flush_added()
+        self._closed = True
+        if self._worker is not None:
+            self._queue.put_nowait(('close', None))
@@ -0,0 +1,148 @@
+import asyncio
+import os, time
+
+from collections import Counter
+
+class AudioCache:
+    '''Byte-budgeted on-disk cache of audio files, keyed by video ID.
+
+    Tracks that get played often are downloaded in the background, and the
+    least frequently played file (least recently used on ties) is evicted
+    when the cache goes over its budget.
+    '''
+
+    def __init__(self, directory: str, max_bytes: int, min_plays: int = 2, max_tracked: int = 10000):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        # plays a track needs before it's worth downloading
+        self.min_plays = min_plays
+        self.max_tracked = max_tracked
+
+        # video_id -> {'path', 'size', 'last_used'}
+        self._files = {}
+        self._plays = Counter()
+        self._downloading = set()
+        self._loaded = False
+        self.size = 0
+
+        self.hits = 0
+        self.misses = 0
+        self.bytes_served = 0
+        self.downloads = 0
+        self.evictions = 0
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            'files': len(self._files),
+            'bytes': self.size,
+            'max_bytes': self.max_bytes,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / lookups if lookups else 0.0,
+            'bytes_served': self.bytes_served,
+            'downloads': self.downloads,
+            'evictions': self.evictions
+        }
+
+    def _scan(self):
+        os.makedirs(self.directory, exist_ok = True)
+        files = {}
+        for entry in os.scandir(self.directory):
+            # yt-dlp leaves .part files behind for downloads that didn't finish
+            if not entry.is_file() or entry.name.endswith('.part'):
+                continue
+            video_id = os.path.splitext(entry.name)[0]
+            stat = entry.stat()
+            files[video_id] = {'path': entry.path, 'size': stat.st_size, 'last_used': stat.st_mtime}
+        return files
+
+    async def load(self):
+        '''Indexes the files already in the cache directory.'''
+        try:
+            files = await asyncio.get_running_loop().run_in_executor(None, self._scan)
+        except Exception as e:
+            print(f'Audio cache scan failed! {e}')
+            return
+        # anything downloaded while we scanned is already in self._files
+        for video_id, entry in files.items():
+            if video_id not in self._files:
+                self._files[video_id] = entry
+                self.size += entry['size']
+        self._loaded = True
+        print(f'Audio cache has {len(self._files)} files, {self.size / 1048576:.1f} MiB.')
+        await self._evict()
+
+    def lookup(self, video_id: str):
+        '''Returns the local file for video_id if it is cached. Doesn't count as a play, see record_play.'''
+        entry = self._files.get(video_id) if video_id else None
+        return entry['path'] if entry else None
+
+    def record_play(self, video_id: str, local: bool):
+        '''Records one play of video_id, from its local copy or not. Returns the bytes served locally, None on a miss.'''
+        if not video_id:
+            return None
+
+        self._plays[video_id] += 1
+        if len(self._plays) > self.max_tracked:
+            # forget the least played half so the counter doesn't grow forever
+            self._plays = Counter(dict(self._plays.most_common(self.max_tracked // 2)))
+
+        entry = self._files.get(video_id)
+        if not local or entry is None:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        self.bytes_served += entry['size']
+        entry['last_used'] = time.time()
+        return entry['size']
+
+    def wants(self, video_id: str) -> bool:
+        '''Whether video_id has been played enough to be worth downloading.'''
+        return (
+            self._loaded
+            and bool(video_id)
+            and video_id not in self._files
+            and video_id not in self._downloading
+            and self._plays[video_id] >= self.min_plays
+        )
+
+    async def download(self, video_id: str, download):
+        '''Downloads video_id with download(directory, video_id) -> (path, size) and adds it to the cache.'''
+        self._downloading.add(video_id)
+        try:
+            result = await download(self.directory, video_id)
+        except Exception as e:
+            print(f'Audio cache download failed for {video_id}: {e}')
+            return
+        finally:
+            self._downloading.discard(video_id)
+
+        if not result:
+            return
+        path, size = result
+        self._files[video_id] = {'path': path, 'size': size, 'last_used': time.time()}
+        self.size += size
+        self.downloads += 1
+        await self._evict()
+
+    async def _evict(self):
+        victims = []
+        while self.size > self.max_bytes and self._files:
+            # least played first, least recently used among equals
+            video_id = min(self._files, key = lambda key: (self._plays[key], self._files[key]['last_used']))
+            entry = self._files.pop(video_id)
+            self.size -= entry['size']
+            self.evictions += 1
+            victims.append(entry['path'])
+
+        if victims:
+            await asyncio.get_running_loop().run_in_executor(None, self._remove, victims)
+
+    def _remove(self, paths: list):
+        for path in paths:
+            try:
+                os.remove(path)
+            except OSError as e:
+                print(f'Failed to remove cached audio {path}: {e}')
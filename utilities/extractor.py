@@ -0,0 +1,232 @@
+import asyncio
+import multiprocessing, os, threading
+
+from urllib.parse import urlparse, parse_qs
+
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+# each worker (process or thread) keeps its own warm YoutubeDL instance here
+_worker = threading.local()
+
+def _init_worker(options: dict):
+    import yt_dlp
+    _worker.options = options
+    _worker.ytdl = yt_dlp.YoutubeDL(options)
+
+def _ping():
+    # runs on a worker once its initializer (and the yt-dlp import in it) is done
+    return True
+
+def stream_expiry(stream_url: str):
+    '''Returns the expiry timestamp baked into a googlevideo URL, or None if it has none.'''
+    try:
+        parsed = urlparse(stream_url)
+        expire = parse_qs(parsed.query).get('expire')
+        if expire:
+            return float(expire[0])
+        # manifest urls carry it as a path segment instead, e.g. /expire/1700000000/
+        parts = parsed.path.split('/')
+        if 'expire' in parts:
+            return float(parts[parts.index('expire') + 1])
+    except (ValueError, IndexError):
+        pass
+    return None
+
+def extract_track(url: str):
+    '''Extracts the fields we keep for a track from a url. Runs inside a worker.'''
+    ytdl = _worker.ytdl
+    data = ytdl.extract_info(url, download = False)
+    if not data:
+        return None
+    if 'entries' in data:
+        data = data['entries'][0]
+
+    return {
+        'title': data.get('title'),
+        'webpage_url': data.get('webpage_url'),
+        'uploader': data.get('uploader'),
+        'duration': data.get('duration'),
+        'acodec': data.get('acodec'),
+        'stream_url': data['url'],
+        'expires_at': stream_expiry(data['url']),
+        'filename': ytdl.prepare_filename(data)
+    }
+
+def _flat_entries(raw_entries: list) -> list:
+    entries = []
+    for entry in raw_entries:
+        # deleted and private videos come back empty or without an id
+        if not entry or not entry.get('id'):
+            continue
+        entries.append({
+            'url': f'https://www.youtube.com/watch?v={entry["id"]}',
+            'title': entry.get('title'),
+            'uploader': entry.get('uploader') or entry.get('channel'),
+            'duration': entry.get('duration')
+        })
+    return entries
+
+def search_tracks(query: str, count: int):
+    '''Returns the top count YouTube results for query, unresolved. Runs inside a worker.'''
+    search_ytdl = getattr(_worker, 'search_ytdl', None)
+    if search_ytdl is None:
+        import yt_dlp
+        # kept around like the main instance, searches come in bursts while people type
+        search_ytdl = _worker.search_ytdl = yt_dlp.YoutubeDL({
+            **_worker.options,
+            'noplaylist': False,
+            'extract_flat': 'in_playlist'
+        })
+    data = search_ytdl.extract_info(f'ytsearch{count}:{query}', download = False)
+    if not data:
+        return []
+    # channels and playlists can show up in results too, those come from the tab extractor
+    videos = [entry for entry in data.get('entries') or [] if entry and entry.get('ie_key', 'Youtube') == 'Youtube']
+    return _flat_entries(videos)
+
+def extract_playlist_page(url: str, start: int, count: int):
+    '''Lists items start to start + count - 1 of a playlist without resolving them. Runs inside a worker.'''
+    import yt_dlp
+
+    options = {
+        **_worker.options,
+        'noplaylist': False,
+        # flat mode only lists the entries, nothing gets resolved
+        'extract_flat': 'in_playlist',
+        'lazy_playlist': True,
+        'playlist_items': f'{start}-{start + count - 1}'
+    }
+    with yt_dlp.YoutubeDL(options) as ytdl:
+        data = ytdl.extract_info(url, download = False)
+    if not data:
+        return None
+
+    raw_entries = list(data.get('entries') or [])
+    entries = _flat_entries(raw_entries)
+
+    return {
+        'title': data.get('title'),
+        'entries': entries,
+        # a short page means we reached the end
+        'complete': len(raw_entries) < count
+    }
+
+def download_audio(url: str, directory: str, video_id: str):
+    '''Downloads the audio for url to directory/<video_id>.<ext>. Runs inside a worker.'''
+    import yt_dlp
+
+    options = {**_worker.options, 'outtmpl': os.path.join(directory, f'{video_id}.%(ext)s')}
+    with yt_dlp.YoutubeDL(options) as downloader:
+        data = downloader.extract_info(url, download = True)
+        if not data:
+            return None
+        if 'entries' in data:
+            data = data['entries'][0]
+
+        downloads = data.get('requested_downloads') or []
+        path = downloads[0].get('filepath') if downloads else downloader.prepare_filename(data)
+
+    if not path or not os.path.exists(path):
+        return None
+    return path, os.path.getsize(path)
+
+class ExtractorPool:
+    '''Runs yt-dlp work in a pool of workers that each own a YoutubeDL instance.
+
+    The process backend keeps extraction (and the GIL it holds) off the bot
+    process entirely. Workers that crash or hang past the timeout get the
+    whole pool recycled.
+    '''
+
+    def __init__(self, options: dict, backend: str = 'process', workers: int = 2, timeout: float = 30.0, max_tasks_per_worker: int = None):
+        if backend not in ('process', 'thread'):
+            raise ValueError(f'Unknown extractor backend {backend}')
+
+        self.options = options
+        self.backend = backend
+        self.workers = workers
+        self.timeout = timeout
+        self.max_tasks_per_worker = max_tasks_per_worker
+
+        # never hand the pool more work than it has workers, so a timeout always means a stuck worker
+        self._semaphore = asyncio.Semaphore(workers)
+        self._executor = None
+
+        self.recycles = 0
+
+    def _create_executor(self):
+        if self.backend == 'thread':
+            return ThreadPoolExecutor(
+                max_workers = self.workers,
+                thread_name_prefix = 'extractor',
+                initializer = _init_worker,
+                initargs = (self.options,)
+            )
+        # spawn, since forking a process that is already running threads isn't safe
+        return ProcessPoolExecutor(
+            max_workers = self.workers,
+            mp_context = multiprocessing.get_context('spawn'),
+            initializer = _init_worker,
+            initargs = (self.options,),
+            max_tasks_per_child = self.max_tasks_per_worker
+        )
+
+    def _get_executor(self):
+        if self._executor is None:
+            self._executor = self._create_executor()
+        return self._executor
+
+    def recycle(self, executor = None):
+        '''Throws away the current workers; new ones are started on the next call.'''
+        executor = executor or self._executor
+        if executor is None or executor is not self._executor:
+            # someone else already replaced it
+            return
+        self._executor = None
+        self.recycles += 1
+
+        if isinstance(executor, ProcessPoolExecutor):
+            # shutdown() waits for running work, so kill hung workers outright
+            for process in list((executor._processes or {}).values()):
+                process.kill()
+        executor.shutdown(wait = False, cancel_futures = True)
+
+    async def run(self, func, *args, timeout: float = None):
+        '''Runs func(*args) on a worker, with the pool's concurrency limit and timeout.'''
+        loop = asyncio.get_running_loop()
+        timeout = timeout or self.timeout
+
+        async with self._semaphore:
+            # a pool that broke under someone else's task gets one retry on fresh workers
+            for attempt in range(2):
+                executor = self._get_executor()
+                try:
+                    future = loop.run_in_executor(executor, func, *args)
+                    return await asyncio.wait_for(future, timeout)
+                except asyncio.TimeoutError:
+                    print(f'Extractor worker timed out after {timeout}s, recycling workers.')
+                    self.recycle(executor)
+                    raise
+                except BrokenProcessPool:
+                    print('Extractor worker died, recycling workers.')
+                    self.recycle(executor)
+                    if attempt:
+                        raise
+
+    async def warm_up(self):
+        '''Starts every worker and loads yt-dlp in it, so the first real extraction doesn't pay for that.'''
+        # the pool only starts another worker when none are idle, so these have to be in flight together
+        results = await asyncio.gather(*(self.run(_ping) for _ in range(self.workers)), return_exceptions = True)
+        for result in results:
+            if isinstance(result, Exception):
+                print(f'Extractor warm-up failed: {result}')
+
+    async def extract(self, url: str):
+        '''Returns track data for url.'''
+        return await self.run(extract_track, url)
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait = False, cancel_futures = True)
+            self._executor = None
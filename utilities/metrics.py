@@ -0,0 +1,190 @@
+import asyncio
+import bisect, threading
+
+from collections import defaultdict
+
+# upper bounds in seconds, from a single frame to a very slow extraction
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+# what each histogram and counter measures, used for the Prometheus HELP lines
+DESCRIPTIONS = {
+    'extraction_seconds': 'Time from submitting an extraction to getting its result',
+    'prefetch_wait_seconds': 'Time play_next spent waiting for the next track to resolve',
+    'first_packet_seconds': 'Time from spawning FFmpeg to its first audio frame',
+    'time_to_first_audio_seconds': 'Time from play_next picking a track to its first frame going out',
+    'transition_gap_seconds': 'Silence between one track ending and the next one starting',
+    'loop_lag_seconds': 'How late the event loop ran a task that was due',
+    'startup_ready_seconds': 'Time from process start to the gateway being ready',
+    'startup_first_command_seconds': 'Time from process start to the first command being accepted',
+    'cache_hits': 'Resolutions answered from the cache',
+    'cache_misses': 'Resolutions that started a new extraction',
+    'cache_joins': 'Resolutions that joined an extraction already in flight',
+    'negative_hits': 'Resolutions answered from the failure cache',
+    'extraction_errors': 'Extractions that raised or returned nothing',
+    'tracks_started': 'Tracks handed to the voice client',
+    'playback_errors': 'Tracks that ended with an error from the voice client',
+    'stream_failures': 'Tracks that ended without producing a single frame',
+    'tracks_skipped': 'Queue entries skipped because they could not be resolved',
+    'loop_stalls': 'Times the event loop was blocked for longer than the watchdog threshold',
+    'audio_cache_hits': 'Tracks played from a local copy in the audio cache',
+    'audio_cache_misses': 'Tracks played from a stream because the audio cache had no copy',
+    'audio_cache_bytes_served': 'Bytes of audio played from the audio cache instead of streamed'
+}
+
+class Histogram:
+    '''Cumulative-bucket histogram, the same shape Prometheus uses.'''
+    __slots__ = ('buckets', 'counts', 'count', 'sum')
+
+    def __init__(self, buckets: tuple = DEFAULT_BUCKETS):
+        self.buckets = buckets
+        # counts[i] is observations <= buckets[i], the last slot is everything above
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def quantile(self, q: float):
+        '''Estimates the q-quantile by interpolating inside its bucket, None when empty.'''
+        if not self.count:
+            return None
+        rank = q * self.count
+        seen = 0
+        for index, count in enumerate(self.counts):
+            if seen + count >= rank and count:
+                lower = self.buckets[index - 1] if index else 0.0
+                if index == len(self.buckets):
+                    # nothing to interpolate towards past the last bucket
+                    return lower
+                return lower + (self.buckets[index] - lower) * (rank - seen) / count
+            seen += count
+        return self.buckets[-1]
+
+    def summary(self) -> dict:
+        return {
+            'count': self.count,
+            'mean': self.sum / self.count if self.count else None,
+            'p50': self.quantile(0.5),
+            'p95': self.quantile(0.95),
+            'p99': self.quantile(0.99)
+        }
+
+class Metrics:
+    '''Histograms and counters kept per guild and globally.
+
+    Observations can come from the voice thread as well as the event loop,
+    so everything goes through a lock. Nothing here does any I/O.
+    '''
+
+    def __init__(self, buckets: tuple = DEFAULT_BUCKETS, prefix: str = 'amoxliatl'):
+        self.buckets = buckets
+        self.prefix = prefix
+        self._lock = threading.Lock()
+        # name -> {guild ID or None for global: Histogram}
+        self._histograms = defaultdict(dict)
+        # name -> {guild ID or None for global: count}
+        self._counters = defaultdict(lambda: defaultdict(int))
+
+    def observe(self, name: str, value: float, guild = None):
+        '''Records a duration (in seconds) for guild and the global total.'''
+        with self._lock:
+            series = self._histograms[name]
+            keys = (None,) if guild is None else (None, guild)
+            for key in keys:
+                histogram = series.get(key)
+                if histogram is None:
+                    histogram = series[key] = Histogram(self.buckets)
+                histogram.observe(value)
+
+    def increment(self, name: str, guild = None, amount: int = 1):
+        '''Bumps a counter for guild and the global total.'''
+        with self._lock:
+            series = self._counters[name]
+            series[None] += amount
+            if guild is not None:
+                series[guild] += amount
+
+    def summary(self, guild = None) -> dict:
+        '''Returns {'histograms': {name: summary}, 'counters': {name: count}} for guild, or globally for None.'''
+        with self._lock:
+            return {
+                'histograms': {name: series[guild].summary() for name, series in self._histograms.items() if guild in series},
+                'counters': {name: series[guild] for name, series in self._counters.items() if guild in series}
+            }
+
+    def render(self) -> str:
+        '''Renders everything in the Prometheus text format, the global series labelled guild="all".'''
+        lines = []
+        with self._lock:
+            for name, series in sorted(self._histograms.items()):
+                metric = f'{self.prefix}_{name}'
+                lines.append(f'# HELP {metric} {DESCRIPTIONS.get(name, name)}')
+                lines.append(f'# TYPE {metric} histogram')
+                for guild, histogram in series.items():
+                    label = f'guild="{"all" if guild is None else guild}"'
+                    cumulative = 0
+                    for bound, count in zip(histogram.buckets, histogram.counts):
+                        cumulative += count
+                        lines.append(f'{metric}_bucket{{{label},le="{bound}"}} {cumulative}')
+                    lines.append(f'{metric}_bucket{{{label},le="+Inf"}} {histogram.count}')
+                    lines.append(f'{metric}_sum{{{label}}} {histogram.sum}')
+                    lines.append(f'{metric}_count{{{label}}} {histogram.count}')
+
+            for name, series in sorted(self._counters.items()):
+                metric = f'{self.prefix}_{name}_total'
+                lines.append(f'# HELP {metric} {DESCRIPTIONS.get(name, name)}')
+                lines.append(f'# TYPE {metric} counter')
+                for guild, count in series.items():
+                    lines.append(f'{metric}{{guild="{"all" if guild is None else guild}"}} {count}')
+        return '\n'.join(lines) + '\n'
+
+class MetricsServer:
+    '''Bare-bones HTTP server answering GET /metrics with Metrics.render().'''
+
+    def __init__(self, metrics: Metrics, host: str = '127.0.0.1', port: int = 9108):
+        self.metrics = metrics
+        self.host = host
+        self.port = port
+        self._server = None
+
+    async def start(self):
+        try:
+            self._server = await asyncio.start_server(self._handle, self.host, self.port)
+        except OSError as e:
+            print(f'Could not start metrics endpoint on {self.host}:{self.port}: {e}')
+            return
+        print(f'Serving metrics on http://{self.host}:{self.port}/metrics')
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            request = await asyncio.wait_for(reader.readline(), timeout = 5)
+            # the headers don't matter, but they have to be read off the socket
+            while (await asyncio.wait_for(reader.readline(), timeout = 5)).strip():
+                pass
+
+            parts = request.decode('latin-1').split()
+            if len(parts) >= 2 and parts[0] == 'GET' and parts[1].split('?')[0] == '/metrics':
+                status, body = '200 OK', self.metrics.render().encode()
+            else:
+                status, body = '404 Not Found', b'Not found\n'
+
+            writer.write(
+                f'HTTP/1.1 {status}\r\n'
+                f'Content-Type: text/plain; version=0.0.4; charset=utf-8\r\n'
+                f'Content-Length: {len(body)}\r\n'
+                f'Connection: close\r\n\r\n'.encode() + body
+            )
+            await writer.drain()
+        except (asyncio.TimeoutError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    async def close(self):
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
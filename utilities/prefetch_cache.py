@@ -0,0 +1,186 @@
+import asyncio
+import json, sqlite3, time
+
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+class PrefetchCache:
+    '''Size-bounded in-memory LRU backed by a SQLite (WAL) store.
+
+    Lookups are served from memory when possible and fall back to an indexed
+    read on the cache thread. Writes land in memory immediately and are
+    persisted in batches, and expired rows are deleted a batch at a time, so
+    the event loop never waits on disk I/O.
+    '''
+
+    def __init__(self, path: str, ttl: float, max_entries: int = 2048, table: str = 'cache', flush_interval: float = 2.0, expiry_interval: float = 60.0, expiry_batch: int = 500):
+        self.path = path
+        # several caches can share one file, each in its own table
+        self.table = table
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.flush_interval = flush_interval
+        self.expiry_interval = expiry_interval
+        self.expiry_batch = expiry_batch
+
+        # key -> (expires_at, data)
+        self._entries = OrderedDict()
+        # entries written to memory but not yet to disk
+        self._pending = {}
+
+        # sqlite connections are bound to one thread, so every disk access goes through this executor
+        self._executor = ThreadPoolExecutor(max_workers = 1, thread_name_prefix = f'prefetch-cache-{table}')
+        self._connection = None
+        self._tasks = []
+
+    def __len__(self):
+        return len(self._entries)
+
+    # disk side, only ever called on the cache thread
+    def _connect(self):
+        if self._connection is None:
+            connection = sqlite3.connect(self.path)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=NORMAL')
+            connection.execute(f'CREATE TABLE IF NOT EXISTS {self.table} (key TEXT PRIMARY KEY, expires_at REAL NOT NULL, data TEXT NOT NULL)')
+            connection.execute(f'CREATE INDEX IF NOT EXISTS {self.table}_expires_at ON {self.table} (expires_at)')
+            connection.commit()
+            self._connection = connection
+        return self._connection
+
+    def _read(self, key: str):
+        row = self._connect().execute(f'SELECT expires_at, data FROM {self.table} WHERE key = ?', (key,)).fetchone()
+        if row is None:
+            return None
+        return row[0], json.loads(row[1])
+
+    def _write(self, items: list):
+        connection = self._connect()
+        connection.executemany(
+            f'INSERT OR REPLACE INTO {self.table} (key, expires_at, data) VALUES (?, ?, ?)',
+            [(key, expires_at, json.dumps(data)) for key, (expires_at, data) in items]
+        )
+        connection.commit()
+
+    def _expire(self, now: float, limit: int):
+        connection = self._connect()
+        cursor = connection.execute(
+            f'DELETE FROM {self.table} WHERE rowid IN (SELECT rowid FROM {self.table} WHERE expires_at <= ? LIMIT ?)',
+            (now, limit)
+        )
+        connection.commit()
+        return cursor.rowcount
+
+    def _close(self):
+        if self._connection is not None:
+            self._connection.close()
+            self._connection = None
+
+    async def _run(self, func, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, func, *args)
+
+    # memory side
+    def _remember(self, key: str, expires_at: float, data: dict):
+        self._entries[key] = (expires_at, data)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last = False)
+
+    async def get(self, key: str):
+        '''Returns the cached data for key, or None if it is missing or expired.'''
+        now = time.time()
+
+        entry = self._entries.get(key) or self._pending.get(key)
+        if entry is None:
+            try:
+                entry = await self._run(self._read, key)
+            except Exception as e:
+                print(f'Cache read failed for {key}: {e}')
+                return None
+            if entry is None:
+                return None
+            # a put may have landed while we were reading, prefer that
+            if key in self._entries:
+                entry = self._entries[key]
+
+        expires_at, data = entry
+        if expires_at <= now:
+            self._entries.pop(key, None)
+            return None
+
+        self._remember(key, expires_at, data)
+        return data
+
+    def items(self):
+        '''Yields the unexpired (key, data) pairs held in memory, without touching disk.'''
+        now = time.time()
+        for key, (expires_at, data) in list(self._entries.items()):
+            if expires_at > now:
+                yield key, data
+
+    def put(self, key: str, data: dict, ttl: float = None, persist: bool = True):
+        '''Stores data under key; it is written to disk by the next flush unless persist is False.'''
+        expires_at = time.time() + (ttl if ttl is not None else self.ttl)
+        self._remember(key, expires_at, data)
+        if persist:
+            self._pending[key] = (expires_at, data)
+
+    async def flush(self):
+        '''Writes all pending entries to disk.'''
+        if not self._pending:
+            return
+        pending, self._pending = self._pending, {}
+        try:
+            await self._run(self._write, list(pending.items()))
+        except Exception as e:
+            print(f'Cache flush failed! Error: {e}')
+            # keep anything that wasn't overwritten in the meantime for the next attempt
+            for key, entry in pending.items():
+                self._pending.setdefault(key, entry)
+
+    async def expire(self):
+        '''Deletes expired entries, a batch at a time so no single step takes long.'''
+        now = time.time()
+        for key in [key for key, (expires_at, _) in self._entries.items() if expires_at <= now]:
+            del self._entries[key]
+
+        while True:
+            try:
+                deleted = await self._run(self._expire, now, self.expiry_batch)
+            except Exception as e:
+                print(f'Cache cleanup failed! {e}')
+                return
+            if deleted < self.expiry_batch:
+                return
+
+    async def _flush_loop(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            await self.flush()
+
+    async def _expiry_loop(self):
+        while True:
+            await asyncio.sleep(self.expiry_interval)
+            await self.expire()
+
+    async def open(self):
+        '''Opens the store ahead of the first lookup, so that lookup doesn't pay for it.'''
+        await self._run(self._connect)
+
+    def start(self):
+        '''Starts the background flush and expiry tasks. Must be called from a running loop.'''
+        if self._tasks:
+            return
+        self._tasks = [
+            asyncio.create_task(self._flush_loop()),
+            asyncio.create_task(self._expiry_loop())
+        ]
+
+    async def close(self):
+        '''Stops the background tasks, flushes pending writes and closes the store.'''
+        for task in self._tasks:
+            task.cancel()
+        self._tasks = []
+        await self.flush()
+        await self._run(self._close)
@@ -0,0 +1,178 @@
+import asyncio
+import json, os, time
+
+from concurrent.futures import ThreadPoolExecutor
+
+def replay(lines) -> dict:
+    '''Rebuilds a guild's queue state from its journal lines.'''
+    state = {'channel': None, 'volume': None, 'current': None, 'position': 0, 'queue': []}
+    for line in lines:
+        try:
+            record = json.loads(line)
+        except ValueError:
+            # a write cut short by a crash, everything before it still counts
+            continue
+
+        op = record.get('op')
+        queue = state['queue']
+        try:
+            if op == 'snapshot':
+                state = {**state, **record['state'], 'queue': list(record['state']['queue'])}
+            elif op == 'append':
+                queue.append(record['entry'])
+            elif op == 'appendleft':
+                queue.insert(0, record['entry'])
+            elif op == 'play':
+                state['current'] = queue.pop(0) if queue else None
+                state['position'] = record.get('position', 0)
+            elif op == 'idle':
+                state['current'] = None
+                state['position'] = 0
+            elif op == 'position':
+                state['position'] = record['position']
+            elif op == 'remove':
+                del queue[record['index']]
+            elif op == 'move':
+                queue.insert(record['to'], queue.pop(record['from']))
+            elif op == 'clear':
+                queue.clear()
+            elif op in ('channel', 'volume'):
+                state[op] = record['value']
+        except (KeyError, IndexError):
+            continue
+    return state
+
+class QueueJournal:
+    '''Append-only journal of each guild's queue, for resuming playback after a restart.
+
+    Every change to a queue is one JSON line in <directory>/<guild ID>.jsonl.
+    Lines are buffered and appended in the background; once a guild's file
+    has compact_after lines it is rewritten as a single snapshot.
+    '''
+
+    def __init__(self, directory: str, compact_after: int = 500, max_age: float = 3600, flush_interval: float = 1.0):
+        self.directory = directory
+        self.compact_after = compact_after
+        # journals untouched for longer than this are stale and not resumed
+        self.max_age = max_age
+        self.flush_interval = flush_interval
+
+        # guild ID -> lines waiting to be appended
+        self._pending = {}
+        # guild ID -> snapshot state the file gets rewritten to on the next flush, None to delete it
+        self._rewrite = {}
+        # guild ID -> lines in the file since its last snapshot
+        self._lengths = {}
+        self._closed = False
+        self._task = None
+        # one thread, so appends and rewrites for a guild never interleave
+        self._executor = ThreadPoolExecutor(max_workers = 1, thread_name_prefix = 'queue-journal')
+
+    def _path(self, guild_id: int) -> str:
+        return os.path.join(self.directory, f'{guild_id}.jsonl')
+
+    def record(self, guild_id: int, record: dict):
+        '''Queues one change for guild_id's journal.'''
+        if self._closed:
+            return
+        self._pending.setdefault(guild_id, []).append(json.dumps(record))
+        self._lengths[guild_id] = self._lengths.get(guild_id, 0) + 1
+
+    def wants_snapshot(self, guild_id: int) -> bool:
+        return self._lengths.get(guild_id, 0) >= self.compact_after
+
+    def snapshot(self, guild_id: int, state: dict):
+        '''Replaces guild_id's journal with a single snapshot of state.'''
+        if self._closed:
+            return
+        self._rewrite[guild_id] = state
+        self._pending.pop(guild_id, None)
+        self._lengths[guild_id] = 1
+
+    def discard(self, guild_id: int):
+        '''Forgets guild_id's journal, e.g. after /stop.'''
+        if self._closed:
+            return
+        self._rewrite[guild_id] = None
+        self._pending.pop(guild_id, None)
+        self._lengths.pop(guild_id, None)
+
+    # disk side, only ever called on the journal thread
+    def _write(self, rewrite: dict, pending: dict):
+        os.makedirs(self.directory, exist_ok = True)
+        for guild_id, state in rewrite.items():
+            path = self._path(guild_id)
+            lines = pending.pop(guild_id, [])
+            if state is not None:
+                lines.insert(0, json.dumps({'op': 'snapshot', 'state': state}))
+            if not lines:
+                if os.path.exists(path):
+                    os.remove(path)
+                continue
+            # written aside and swapped in, so a crash mid-write leaves the old journal intact
+            with open(f'{path}.tmp', 'w') as file:
+                file.write('\n'.join(lines) + '\n')
+            os.replace(f'{path}.tmp', path)
+
+        for guild_id, lines in pending.items():
+            with open(self._path(guild_id), 'a') as file:
+                file.write('\n'.join(lines) + '\n')
+
+    def _read_all(self):
+        states, lengths = {}, {}
+        if not os.path.isdir(self.directory):
+            return states, lengths
+        now = time.time()
+        for entry in os.scandir(self.directory):
+            name, extension = os.path.splitext(entry.name)
+            if extension != '.jsonl' or not name.isdigit():
+                continue
+            if now - entry.stat().st_mtime > self.max_age:
+                os.remove(entry.path)
+                continue
+            with open(entry.path) as file:
+                lines = file.read().splitlines()
+            states[int(name)] = replay(lines)
+            lengths[int(name)] = len(lines)
+        return states, lengths
+
+    async def _run(self, func, *args):
+        return await asyncio.get_running_loop().run_in_executor(self._executor, func, *args)
+
+    async def load(self) -> dict:
+        '''Returns {guild ID: state} for every journal that isn't stale.'''
+        try:
+            states, lengths = await self._run(self._read_all)
+        except Exception as e:
+            print(f'Failed to read queue journals: {e}')
+            return {}
+        self._lengths.update(lengths)
+        return states
+
+    async def flush(self):
+        if not self._pending and not self._rewrite:
+            return
+        rewrite, self._rewrite = self._rewrite, {}
+        pending, self._pending = self._pending, {}
+        try:
+            await self._run(self._write, rewrite, pending)
+        except Exception as e:
+            print(f'Failed to write queue journal: {e}')
+
+    async def _flush_loop(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            await self.flush()
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._flush_loop())
+
+    async def close(self):
+        '''Writes everything still pending and stops taking new records.'''
+        self._closed = True
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        await self.flush()
+        self._executor.shutdown(wait = False)
@@ -0,0 +1,252 @@
+import asyncio
+import re, time
+
+from urllib.parse import urlparse, parse_qs
+
+from utilities.scheduler import PRIORITY_PREFETCH
+
+VIDEO_ID = re.compile(r'^[A-Za-z0-9_-]{11}$')
+YOUTUBE_HOSTS = ('youtube.com', 'youtube-nocookie.com')
+# path prefixes that are followed directly by a video id, e.g. /shorts/<id>
+VIDEO_PATHS = ('shorts', 'embed', 'live', 'v', 'e')
+
+# which tier each field of the track data is cached in
+METADATA_FIELDS = ('title', 'uploader', 'duration', 'webpage_url')
+STREAM_FIELDS = ('stream_url', 'expires_at', 'acodec', 'filename')
+
+def _parse(url: str):
+    url = url.strip()
+    if '://' not in url:
+        url = f'https://{url}'
+    parsed = urlparse(url)
+    host = (parsed.hostname or '').lower()
+    if host.startswith('www.'):
+        host = host[4:]
+    return parsed, host
+
+def _is_youtube_host(host: str) -> bool:
+    # youtube.com itself or any subdomain of it, never notyoutube.com
+    return any(host == domain or host.endswith(f'.{domain}') for domain in YOUTUBE_HOSTS)
+
+def get_cache_key(url: str):
+    '''Converts any youtube url form into its canonical video ID, to be used in the cache.'''
+    try:
+        parsed, host = _parse(url)
+    except ValueError:
+        return None
+
+    video_id = None
+    if host == 'youtu.be':
+        video_id = parsed.path.strip('/').split('/')[0]
+    elif _is_youtube_host(host):
+        # covers m., music. and any other subdomain
+        parts = parsed.path.strip('/').split('/')
+        if parts[0] == 'watch':
+            video_id = parse_qs(parsed.query).get('v', [None])[0]
+        elif len(parts) > 1 and parts[0] in VIDEO_PATHS:
+            video_id = parts[1]
+
+    if video_id and VIDEO_ID.match(video_id):
+        return video_id
+    return None
+
+def is_youtube_url(text: str) -> bool:
+    '''Whether text is a link to youtube rather than, say, a search query.'''
+    text = text.strip()
+    if not text or any(character.isspace() for character in text):
+        return False
+    try:
+        _, host = _parse(text)
+    except ValueError:
+        return False
+    return host == 'youtu.be' or _is_youtube_host(host)
+
+def get_playlist_id(url: str):
+    '''Returns the list= ID of a playlist or mix url, or None if it doesn't have one.'''
+    try:
+        parsed, _ = _parse(url)
+    except ValueError:
+        return None
+    return parse_qs(parsed.query).get('list', [None])[0]
+
+def needs_refresh(data: dict, margin: float) -> bool:
+    '''Whether the stream URL in data expires within margin seconds.'''
+    expires_at = data.get('expires_at')
+    return not expires_at or expires_at - time.time() < margin
+
+def is_download_error(error: BaseException) -> bool:
+    '''Whether error is yt-dlp refusing the video, rather than our workers failing to run it.'''
+    # yt-dlp is already loaded by whatever raised it, this just avoids importing it up front
+    from yt_dlp.utils import DownloadError
+    return isinstance(error, DownloadError)
+
+class Resolver:
+    '''Cache-aware, single-flight front for track extraction.
+
+    Concurrent requests for the same video share one in-flight extraction
+    instead of each starting their own. Results are cached in two tiers:
+    long-lived metadata and short-lived stream URLs, with failed extractions
+    remembered in the stream tier for failure_ttl.
+    '''
+
+    def __init__(self, metadata, streams, scheduler, extract, expiry_margin: float = 300, metadata_ttl: float = 2592000, failure_ttl: float = 600, metrics = None):
+        self.metadata = metadata
+        self.streams = streams
+        self.scheduler = scheduler
+        # worker function taking a url and returning track data (or None)
+        self.extract = extract
+        # stream urls are cached until this long before they expire
+        self.expiry_margin = expiry_margin
+        self.metadata_ttl = metadata_ttl
+        self.failure_ttl = failure_ttl
+        # optional utilities.metrics.Metrics, fed per group (guild)
+        self.metrics = metrics
+
+        self._inflight = {}
+
+        self.hits = 0
+        self.joins = 0
+        self.misses = 0
+        self.refreshes = 0
+        self.negative_hits = 0
+
+    def _count(self, name: str, group):
+        if self.metrics:
+            self.metrics.increment(name, group)
+
+    def start(self):
+        self.metadata.start()
+        self.streams.start()
+
+    async def warm_up(self):
+        await asyncio.gather(self.metadata.open(), self.streams.open())
+
+    async def close(self):
+        await self.metadata.close()
+        await self.streams.close()
+
+    def stats(self) -> dict:
+        '''Returns the hit/join/miss counters.'''
+        return {
+            'hits': self.hits,
+            'joins': self.joins,
+            'misses': self.misses,
+            'refreshes': self.refreshes,
+            'negative_hits': self.negative_hits,
+            'inflight': len(self._inflight),
+            'queued': len(self.scheduler),
+            'cancelled': self.scheduler.cancelled
+        }
+
+    async def resolve(self, url: str, priority: int = PRIORITY_PREFETCH, group = None, refresh: bool = False):
+        '''Returns track data for url from the cache, an in-flight extraction, or a new one.
+
+        Joining an in-flight extraction with a more urgent priority bumps it in
+        the scheduler. group (usually a guild ID) lets the extraction be
+        cancelled with scheduler.cancel_group() before it starts. refresh skips
+        the cache, for when the stream URL we have is stale or failed.
+        '''
+        cache_key = get_cache_key(url)
+        # urls we can't turn into an ID still get de-duplicated, just not cached
+        key = cache_key or url
+
+        inflight = self._inflight.get(key)
+        if refresh:
+            self.refreshes += 1
+        elif inflight is None and cache_key:
+            stream = await self.streams.get(cache_key)
+            if stream and stream.get('failed'):
+                # this failed recently, don't hammer youtube with it again
+                self.negative_hits += 1
+                self._count('negative_hits', group)
+                return None
+            if stream:
+                metadata = await self.metadata.get(cache_key)
+                if metadata:
+                    self.hits += 1
+                    self._count('cache_hits', group)
+                    return {**metadata, **stream}
+            # another caller may have started extracting while we looked at the cache
+            inflight = self._inflight.get(key)
+
+        if inflight is not None:
+            self.joins += 1
+            self._count('cache_joins', group)
+            task, job = inflight
+            self.scheduler.join(job, priority, group)
+        else:
+            self.misses += 1
+            self._count('cache_misses', group)
+            job = self.scheduler.submit(self.extract, url, priority = priority, group = group)
+            task = asyncio.create_task(self._extract(job, url, cache_key, group))
+            self._inflight[key] = (task, job)
+            task.add_done_callback(lambda done: self._forget(key, done))
+
+        # shield so one caller giving up doesn't cancel the extraction for everyone else
+        return await asyncio.shield(task)
+
+    async def get_metadata(self, url: str):
+        '''Returns cached title/uploader/duration for url without touching the network, or None.'''
+        cache_key = get_cache_key(url)
+        if not cache_key:
+            return None
+        return await self.metadata.get(cache_key)
+
+    def seed_metadata(self, url: str, metadata: dict, persist: bool = True):
+        '''Stores metadata we got for free elsewhere, e.g. from a flat playlist listing; persist False keeps it in memory only.'''
+        cache_key = get_cache_key(url)
+        if cache_key:
+            self.metadata.put(cache_key, {field: metadata.get(field) for field in METADATA_FIELDS}, ttl = self.metadata_ttl, persist = persist)
+
+    def submit(self, func, *args, priority: int = PRIORITY_PREFETCH, group = None, timeout: float = None) -> asyncio.Future:
+        '''Runs uncached worker work, e.g. playlist pages, through the scheduler; the future is cancelled along with its group.'''
+        return self.scheduler.submit(func, *args, priority = priority, group = group, timeout = timeout).future
+
+    def cancel_group(self, group):
+        self.scheduler.cancel_group(group)
+
+    def release(self, url: str, group):
+        '''Drops group's interest in the queued extraction for url, which is cancelled if nobody else wants it.'''
+        inflight = self._inflight.get(get_cache_key(url) or url)
+        if inflight is not None:
+            self.scheduler.release(inflight[1], group)
+
+    def _forget(self, key: str, task: asyncio.Task):
+        inflight = self._inflight.get(key)
+        if inflight and inflight[0] is task:
+            del self._inflight[key]
+
+    async def _extract(self, job, url: str, cache_key: str, group = None):
+        submitted_at = time.perf_counter()
+        await asyncio.wait([job.future])
+        if job.future.cancelled():
+            # everyone who wanted it went away before it started
+            return None
+        if self.metrics:
+            # includes time queued in the scheduler, which is what callers actually wait through
+            self.metrics.observe('extraction_seconds', time.perf_counter() - submitted_at, group)
+        error = job.future.exception()
+        if error:
+            print(f'Prefetch error for video {url}: {error}')
+        data = None if error else job.future.result()
+
+        if not data:
+            self._count('extraction_errors', group)
+            # only remember failures that say something about the video; timeouts and broken
+            # or shut down workers say more about us, and the next attempt may well work
+            if cache_key and (error is None or is_download_error(error)):
+                self.streams.put(cache_key, {'failed': True}, ttl = self.failure_ttl)
+            return None
+
+        now = time.time()
+        if not data.get('expires_at'):
+            # no expiry in the url, assume it lasts as long as the stream cache ttl
+            data['expires_at'] = now + self.streams.ttl
+
+        if cache_key:
+            self.metadata.put(cache_key, {field: data.get(field) for field in METADATA_FIELDS}, ttl = self.metadata_ttl)
+            # keep the stream only until shortly before its url goes stale
+            ttl = min(self.streams.ttl, data['expires_at'] - self.expiry_margin - now)
+            if ttl > 0:
+                self.streams.put(cache_key, {field: data.get(field) for field in STREAM_FIELDS}, ttl = ttl)
+        return data
@@ -0,0 +1,368 @@
+import asyncio
+import itertools, json, os, time
+
+from utilities.scheduler import PRIORITY_PREFETCH
+
+# responses can carry whole playlist pages, well past asyncio's 64 KiB default line limit
+LINE_LIMIT = 2 ** 22
+
+def parse_address(address: str):
+    '''Returns (host, port) for 'host:port', or (path, None) for a Unix socket path.'''
+    host, _, port = address.rpartition(':')
+    if host and port.isdigit() and '/' not in address:
+        return host, int(port)
+    return address, None
+
+class ResolverUnavailable(ConnectionError):
+    '''The resolver daemon isn't running or went away.'''
+
+class ResolverService:
+    '''Serves a Resolver to every bot process on the host, over a Unix socket or localhost TCP.
+
+    One JSON object per line each way. Requests are {'id', 'op', ...} and
+    answered with {'id', 'result'}, {'id', 'error'} or {'id', 'cancelled'},
+    in whatever order they finish. Groups are namespaced per connection, so
+    guild IDs from different processes never mix, and a client that
+    disconnects has its queued work cancelled.
+    '''
+
+    def __init__(self, resolver, functions: dict, address: str):
+        self.resolver = resolver
+        # worker functions clients may run by name through resolver.submit
+        self.functions = functions
+        self.address = address
+        self._server = None
+        self._connections = itertools.count(1)
+        self._writers = set()
+
+        self.clients = 0
+        self.requests = 0
+
+    async def start(self):
+        host, port = parse_address(self.address)
+        try:
+            if port is None:
+                # left behind by a daemon that didn't shut down cleanly
+                if os.path.exists(host):
+                    os.remove(host)
+                self._server = await asyncio.start_unix_server(self._handle, host, limit = LINE_LIMIT)
+            else:
+                self._server = await asyncio.start_server(self._handle, host, port, limit = LINE_LIMIT)
+        except OSError as e:
+            print(f'Could not start resolver service on {self.address}: {e}')
+            raise
+        print(f'Resolver service listening on {self.address}')
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        connection = next(self._connections)
+        groups = set()
+        tasks = set()
+        self._writers.add(writer)
+        self.clients += 1
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                try:
+                    request = json.loads(line)
+                except ValueError:
+                    continue
+                task = asyncio.create_task(self._answer(connection, groups, request, writer))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+        except (ConnectionError, asyncio.LimitOverrunError, ValueError) as e:
+            print(f'Resolver client {connection} dropped: {e}')
+        finally:
+            self.clients -= 1
+            # nobody is left to hand the results to
+            for group in groups:
+                self.resolver.cancel_group(group)
+            for task in tasks:
+                task.cancel()
+            self._writers.discard(writer)
+            writer.close()
+
+    async def _answer(self, connection: int, groups: set, request: dict, writer: asyncio.StreamWriter):
+        self.requests += 1
+        response = {'id': request.get('id')}
+        group = request.get('group')
+        if group is not None:
+            group = f'{connection}:{group}'
+            groups.add(group)
+        priority = request.get('priority', PRIORITY_PREFETCH)
+
+        try:
+            op = request.get('op')
+            if op == 'resolve':
+                response['result'] = await self.resolver.resolve(request['url'], priority = priority, group = group, refresh = request.get('refresh', False))
+            elif op == 'metadata':
+                response['result'] = await self.resolver.get_metadata(request['url'])
+            elif op == 'seed':
+                self.resolver.seed_metadata(request['url'], request['metadata'])
+                response['result'] = None
+            elif op == 'run':
+                func = self.functions.get(request['func'])
+                if func is None:
+                    raise ValueError(f"Unknown function {request['func']}")
+                future = self.resolver.submit(func, *request['args'], priority = priority, group = group, timeout = request.get('timeout'))
+                await asyncio.wait([future])
+                if future.cancelled():
+                    response['cancelled'] = True
+                else:
+                    response['result'] = future.result()
+            elif op == 'cancel':
+                self.resolver.cancel_group(group)
+                response['result'] = None
+            elif op == 'release':
+                self.resolver.release(request['url'], group)
+                response['result'] = None
+            elif op == 'ping':
+                response['result'] = True
+            elif op == 'stats':
+                response['result'] = {**self.resolver.stats(), 'clients': self.clients, 'requests': self.requests}
+            else:
+                response['error'] = f'Unknown op {op}'
+        except Exception as e:
+            response.pop('result', None)
+            response['error'] = str(e) or type(e).__name__
+
+        try:
+            writer.write(json.dumps(response).encode() + b'\n')
+            await writer.drain()
+        except ConnectionError:
+            pass
+
+    async def close(self):
+        if self._server is not None:
+            self._server.close()
+            # clients see the connection drop and fall back to extracting themselves
+            for writer in list(self._writers):
+                writer.close()
+            await self._server.wait_closed()
+            self._server = None
+            host, port = parse_address(self.address)
+            if port is None and os.path.exists(host):
+                os.remove(host)
+
+class ResolverClient:
+    '''Drop-in for Resolver that hands the work to the resolver daemon.
+
+    Whenever the daemon can't be reached, calls fall through to local, an
+    in-process Resolver, and connecting is retried at most once every
+    retry_interval seconds. A call the daemon takes longer than timeout to
+    answer falls through on its own; the connection is only dropped when
+    the daemon misses a ping. Errors the daemon reports are raised as they
+    would be locally, they don't trigger the fallback.
+    '''
+
+    def __init__(self, local, address: str, timeout: float = 120.0, retry_interval: float = 10.0, ping_interval: float = 10.0, ping_timeout: float = 5.0):
+        self.local = local
+        self.address = address
+        # how long one caller waits on the daemon before doing the work itself
+        self.timeout = timeout
+        self.retry_interval = retry_interval
+        # pings are answered straight off the daemon's loop, so a slow one means it's hung or gone rather than busy
+        self.ping_interval = ping_interval
+        self.ping_timeout = ping_timeout
+
+        self._reader = None
+        self._writer = None
+        self._reader_task = None
+        self._heartbeat_task = None
+        self._connecting = None
+        self._retry_at = 0.0
+        self._ids = itertools.count(1)
+        # request ID -> future for its response
+        self._pending = {}
+
+        self.remote_calls = 0
+        self.fallbacks = 0
+
+    @property
+    def connected(self) -> bool:
+        return self._writer is not None
+
+    async def _connect(self):
+        host, port = parse_address(self.address)
+        try:
+            if port is None:
+                self._reader, self._writer = await asyncio.open_unix_connection(host, limit = LINE_LIMIT)
+            else:
+                self._reader, self._writer = await asyncio.open_connection(host, port, limit = LINE_LIMIT)
+        except OSError:
+            self._retry_at = time.monotonic() + self.retry_interval
+            return
+        self._reader_task = asyncio.create_task(self._read_loop(self._reader, self._writer))
+        self._heartbeat_task = asyncio.create_task(self._heartbeat(self._writer))
+        print(f'Connected to resolver service on {self.address}')
+
+    async def _ensure_connected(self):
+        if self.connected:
+            return
+        if time.monotonic() < self._retry_at:
+            raise ResolverUnavailable(self.address)
+        # concurrent callers share one attempt
+        if self._connecting is None:
+            self._connecting = asyncio.create_task(self._connect())
+            self._connecting.add_done_callback(lambda _: setattr(self, '_connecting', None))
+        await asyncio.shield(self._connecting)
+        if not self.connected:
+            raise ResolverUnavailable(self.address)
+
+    async def _read_loop(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                response = json.loads(line)
+                future = self._pending.pop(response.get('id'), None)
+                if future is None or future.done():
+                    continue
+                if 'error' in response:
+                    future.set_exception(RuntimeError(response['error']))
+                elif response.get('cancelled'):
+                    future.cancel()
+                else:
+                    future.set_result(response.get('result'))
+        except (ConnectionError, ValueError) as e:
+            print(f'Lost the resolver service: {e}')
+        finally:
+            # a dropped connection can finish reading after we already replaced it
+            if self._writer is writer:
+                self._disconnect()
+
+    async def _heartbeat(self, writer: asyncio.StreamWriter):
+        while self._writer is writer:
+            await asyncio.sleep(self.ping_interval)
+            if self._writer is not writer:
+                return
+            try:
+                await self._call('ping', answer_timeout = self.ping_timeout)
+            except ResolverUnavailable:
+                if self._writer is writer:
+                    print('Resolver service missed a ping, dropping it')
+                    self._disconnect()
+                return
+            except Exception:
+                # it answered, just not with what we expected
+                pass
+
+    def _disconnect(self):
+        if self._writer is not None:
+            self._writer.close()
+        self._reader = self._writer = None
+        self._retry_at = time.monotonic() + self.retry_interval
+        pending, self._pending = self._pending, {}
+        for future in pending.values():
+            if not future.done():
+                future.set_exception(ResolverUnavailable(self.address))
+
+    async def _call(self, op: str, answer_timeout: float = None, **fields):
+        await self._ensure_connected()
+        request_id = next(self._ids)
+        future = asyncio.get_running_loop().create_future()
+        self._pending[request_id] = future
+        try:
+            self._writer.write(json.dumps({'id': request_id, 'op': op, **fields}).encode() + b'\n')
+            await self._writer.drain()
+        except ConnectionError:
+            self._disconnect()
+        self.remote_calls += 1
+        answer_timeout = answer_timeout or self.timeout
+        try:
+            return await asyncio.wait_for(asyncio.shield(future), answer_timeout)
+        except asyncio.TimeoutError:
+            # only this call gives up, the daemon is probably just busy and everything else on the connection stays put
+            raise ResolverUnavailable(f'{self.address} took over {answer_timeout:.0f}s to answer {op}')
+        finally:
+            self._pending.pop(request_id, None)
+
+    def _send(self, op: str, **fields):
+        '''Fire and forget, for calls nobody waits on.'''
+        async def send():
+            try:
+                await self._call(op, **fields)
+            except Exception:
+                pass
+        asyncio.create_task(send())
+
+    def start(self):
+        self.local.start()
+
+    async def warm_up(self):
+        await self.local.warm_up()
+        try:
+            await self._ensure_connected()
+        except ResolverUnavailable:
+            print(f'No resolver service on {self.address}, extracting in-process')
+
+    async def close(self):
+        for task in (self._reader_task, self._heartbeat_task):
+            if task is not None:
+                task.cancel()
+        self._reader_task = self._heartbeat_task = None
+        self._disconnect()
+        await self.local.close()
+
+    def stats(self) -> dict:
+        return {**self.local.stats(), 'remote_calls': self.remote_calls, 'fallbacks': self.fallbacks, 'connected': self.connected}
+
+    async def remote_stats(self, timeout: float = 2.0):
+        '''The daemon's own counters, across every bot process, or None if it can't be reached in time.'''
+        try:
+            return await self._call('stats', answer_timeout = timeout)
+        except ResolverUnavailable:
+            return None
+
+    def _mirror(self, url: str, metadata: dict):
+        # titles the daemon knows, kept in our memory too for lookups that never leave the process, like autocomplete;
+        # the daemon owns the cache file, so nothing is written to disk here
+        if metadata and metadata.get('title'):
+            self.local.seed_metadata(url, metadata, persist = False)
+
+    async def resolve(self, url: str, priority: int = PRIORITY_PREFETCH, group = None, refresh: bool = False):
+        try:
+            data = await self._call('resolve', url = url, priority = priority, group = group, refresh = refresh)
+            self._mirror(url, data)
+            return data
+        except ResolverUnavailable:
+            self.fallbacks += 1
+            return await self.local.resolve(url, priority = priority, group = group, refresh = refresh)
+
+    async def get_metadata(self, url: str):
+        try:
+            metadata = await self._call('metadata', url = url)
+            self._mirror(url, metadata)
+            return metadata
+        except ResolverUnavailable:
+            self.fallbacks += 1
+            return await self.local.get_metadata(url)
+
+    def seed_metadata(self, url: str, metadata: dict):
+        if self.connected:
+            self._send('seed', url = url, metadata = metadata)
+            self._mirror(url, metadata)
+        else:
+            self.local.seed_metadata(url, metadata)
+
+    def submit(self, func, *args, priority: int = PRIORITY_PREFETCH, group = None, timeout: float = None) -> asyncio.Future:
+        async def run():
+            try:
+                return await self._call('run', func = func.__name__, args = list(args), priority = priority, group = group, timeout = timeout)
+            except ResolverUnavailable:
+                self.fallbacks += 1
+                return await self.local.submit(func, *args, priority = priority, group = group, timeout = timeout)
+        # a task is a future, and cancelled like the local one when the daemon cancels the job
+        return asyncio.create_task(run())
+
+    def cancel_group(self, group):
+        self.local.cancel_group(group)
+        if self.connected:
+            self._send('cancel', group = group)
+
+    def release(self, url: str, group):
+        self.local.release(url, group)
+        if self.connected:
+            self._send('release', url = url, group = group)
@@ -0,0 +1,154 @@
+import asyncio
+import heapq, itertools, time
+
+# priority classes, lower runs first
+PRIORITY_PLAYBACK = 0 # needed for playback right now
+PRIORITY_PREFETCH = 1 # lookahead for upcoming tracks
+PRIORITY_METADATA = 2 # cosmetic, e.g. titles for announcements
+PRIORITY_BACKGROUND = 3 # housekeeping, e.g. downloads for the audio cache
+
+class TokenBucket:
+    '''Allows rate requests per second on average, with bursts of up to burst.'''
+
+    def __init__(self, rate: float, burst: int):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    async def acquire(self):
+        while True:
+            self._refill()
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+            await asyncio.sleep((1 - self.tokens) / self.rate)
+
+    def refund(self):
+        self.tokens = min(self.burst, self.tokens + 1)
+
+class Job:
+    '''A unit of work waiting in the scheduler.'''
+    __slots__ = ('priority', 'func', 'args', 'timeout', 'future', 'groups', 'started')
+
+    def __init__(self, priority: int, func, args: tuple, groups: set, timeout: float = None):
+        self.priority = priority
+        self.func = func
+        self.args = args
+        self.timeout = timeout
+        self.future = asyncio.get_running_loop().create_future()
+        # who is waiting on this job; None means someone who can't cancel it
+        self.groups = groups
+        self.started = False
+
+    def done(self):
+        return self.future.done()
+
+class ExtractionScheduler:
+    '''Priority queue in front of the extractor with token-bucket rate limiting.
+
+    Playback work always goes out before prefetch lookahead, which goes out
+    before cosmetic metadata lookups. Jobs that haven't started can be
+    re-prioritised or cancelled per group (e.g. per guild).
+    '''
+
+    def __init__(self, run, rate: float = 1.0, burst: int = 3, concurrency: int = 2, bucket: TokenBucket = None):
+        # async callable, run(func, *args, timeout = None) -> result
+        self.run = run
+        # schedulers in front of different workers can share one bucket, so they share the rate limit too
+        self.bucket = bucket or TokenBucket(rate, burst)
+        self.concurrency = concurrency
+
+        # (priority, sequence, job); a job can appear more than once after being re-prioritised
+        self._heap = []
+        self._sequence = itertools.count()
+        self._available = asyncio.Event()
+        self._workers = []
+
+        self.cancelled = 0
+
+    def __len__(self):
+        return sum(1 for _, _, job in self._heap if not job.started and not job.done())
+
+    def _push(self, job: Job):
+        heapq.heappush(self._heap, (job.priority, next(self._sequence), job))
+        self._available.set()
+
+    def _pop(self):
+        while self._heap:
+            priority, _, job = heapq.heappop(self._heap)
+            # skip stale entries left behind by join() and jobs that were cancelled
+            if job.started or job.done() or priority != job.priority:
+                continue
+            return job
+        self._available.clear()
+        return None
+
+    def submit(self, func, *args, priority: int = PRIORITY_PREFETCH, group = None, timeout: float = None) -> Job:
+        '''Queues func(*args) and returns its Job; await job.future for the result.'''
+        if not self._workers:
+            self._workers = [asyncio.create_task(self._worker()) for _ in range(self.concurrency)]
+
+        job = Job(priority, func, args, {group}, timeout)
+        self._push(job)
+        return job
+
+    def join(self, job: Job, priority: int, group = None):
+        '''Registers another waiter on job, raising its priority if the new one is more urgent.'''
+        job.groups.add(group)
+        if priority < job.priority and not job.started and not job.done():
+            job.priority = priority
+            self._push(job)
+
+    def release(self, job: Job, group, min_priority: int = PRIORITY_PREFETCH) -> bool:
+        '''Drops group's interest in job if it is queued at min_priority or lower; returns whether that cancelled it.'''
+        if job.started or job.done() or job.priority < min_priority:
+            return False
+        job.groups.discard(group)
+        if job.groups:
+            return False
+        job.future.cancel()
+        self.cancelled += 1
+        return True
+
+    def cancel_group(self, group, min_priority: int = PRIORITY_PREFETCH):
+        '''Drops group's interest in queued jobs at min_priority or lower; jobs nobody else wants are cancelled.'''
+        for _, _, job in self._heap:
+            self.release(job, group, min_priority)
+
+    async def _worker(self):
+        while True:
+            await self._available.wait()
+            # wait for the rate limit before choosing, so the most urgent job at that moment wins
+            await self.bucket.acquire()
+            job = self._pop()
+            if job is None:
+                self.bucket.refund()
+                continue
+
+            job.started = True
+            try:
+                result = await self.run(job.func, *job.args, timeout = job.timeout)
+            except asyncio.CancelledError:
+                job.future.cancel()
+                raise
+            except Exception as e:
+                if not job.done():
+                    job.future.set_exception(e)
+            else:
+                if not job.done():
+                    job.future.set_result(result)
+
+    def shutdown(self):
+        for worker in self._workers:
+            worker.cancel()
+        self._workers = []
+        for _, _, job in self._heap:
+            if not job.done():
+                job.future.cancel()
+        self._heap = []
@@ -0,0 +1,146 @@
+import asyncio
+import time
+
+from collections import OrderedDict
+
+def normalize(query: str) -> str:
+    return ' '.join(query.lower().split())
+
+def matches(title: str, words: list) -> bool:
+    title = (title or '').lower()
+    return all(word in title for word in words)
+
+class Searcher:
+    '''YouTube search for /play and its autocomplete.
+
+    Results are kept in an LRU keyed by normalized query. A query nobody
+    searched yet is answered from its longest cached prefix (filtered down
+    to titles that still match) plus titles already in the metadata cache,
+    so each keystroke gets something back straight away. Real searches
+    only run once the user stops typing for debounce seconds, and
+    concurrent identical searches share one extraction.
+    '''
+
+    def __init__(self, search, metadata = None, max_queries: int = 1000, ttl: float = 3600, debounce: float = 0.4, budget: float = 2.0, min_length: int = 3):
+        # async search(query, priority) -> [{'url', 'title', 'uploader', 'duration'}]
+        self.search_func = search
+        # optional PrefetchCache of track metadata, searched in memory for titles we already know
+        self.metadata = metadata
+        self.max_queries = max_queries
+        self.ttl = ttl
+        self.debounce = debounce
+        # how long autocomplete waits on a real search before settling for what's cached
+        self.budget = budget
+        self.min_length = min_length
+
+        # normalized query -> (expires_at, results), least recently used first
+        self._results = OrderedDict()
+        self._inflight = {}
+        # user ID -> the last query they typed, to notice when a keystroke was superseded
+        self._latest = {}
+
+        self.hits = 0
+        self.prefix_hits = 0
+        self.searches = 0
+
+    def cached(self, query: str):
+        '''Returns the results for exactly query, or None.'''
+        item = self._results.get(query)
+        if item is None:
+            return None
+        expires_at, results = item
+        if expires_at <= time.time():
+            del self._results[query]
+            return None
+        self._results.move_to_end(query)
+        return results
+
+    def approximate(self, query: str, limit: int = 25) -> list:
+        '''Best guess without searching: the longest cached prefix's results that still match, then known titles.'''
+        words = query.split()
+        results = []
+        for length in range(len(query) - 1, self.min_length - 1, -1):
+            prefix_results = self.cached(query[:length])
+            if prefix_results is not None:
+                results = [result for result in prefix_results if matches(result['title'], words)]
+                if results:
+                    self.prefix_hits += 1
+                break
+
+        seen = {result['url'] for result in results}
+        for result in self.local(query, limit):
+            if len(results) >= limit:
+                break
+            if result['url'] not in seen:
+                results.append(result)
+        return results
+
+    def local(self, query: str, limit: int = 25) -> list:
+        '''Tracks in the metadata cache whose titles contain every word of query.'''
+        if self.metadata is None or not query:
+            return []
+        words = query.split()
+        results = []
+        for video_id, data in self.metadata.items():
+            if matches(data.get('title'), words):
+                results.append({
+                    'url': f'https://www.youtube.com/watch?v={video_id}',
+                    'title': data['title'],
+                    'uploader': data.get('uploader'),
+                    'duration': data.get('duration')
+                })
+                if len(results) >= limit:
+                    break
+        return results
+
+    async def search(self, query: str, priority: int = None) -> list:
+        '''Returns the results for query, searching YouTube if they aren't cached.'''
+        query = normalize(query)
+        results = self.cached(query)
+        if results is not None:
+            self.hits += 1
+            return results
+
+        task = self._inflight.get(query)
+        if task is None:
+            task = asyncio.create_task(self._search(query, priority))
+            self._inflight[query] = task
+            task.add_done_callback(lambda _: self._inflight.pop(query, None))
+        # shielded, a caller giving up shouldn't waste a search that is still useful to the cache
+        return await asyncio.shield(task)
+
+    async def _search(self, query: str, priority: int):
+        self.searches += 1
+        results = await self.search_func(query, priority)
+        self._results[query] = (time.time() + self.ttl, results)
+        self._results.move_to_end(query)
+        while len(self._results) > self.max_queries:
+            self._results.popitem(last = False)
+        return results
+
+    async def suggest(self, query: str, user_id: int, priority: int = None) -> list:
+        '''Autocomplete results for what user_id has typed so far, always within budget.'''
+        query = normalize(query)
+        if len(query) < self.min_length:
+            return self.local(query)
+
+        results = self.cached(query)
+        if results is not None:
+            self.hits += 1
+            return results
+
+        # wait for the user to stop typing; a newer keystroke makes this one moot
+        self._latest[user_id] = query
+        await asyncio.sleep(self.debounce)
+        if self._latest.get(user_id) != query:
+            return self.approximate(query)
+        del self._latest[user_id]
+
+        try:
+            return await asyncio.wait_for(self.search(query, priority), self.budget)
+        except asyncio.TimeoutError:
+            # the search carries on and will be cached for the next keystroke
+            return self.approximate(query)
+        except Exception as e:
+            print(f'Search failed for {query}: {e}')
+            return self.approximate(query)
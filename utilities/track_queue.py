@@ -0,0 +1,134 @@
+import random
+
+from collections import deque
+from itertools import islice
+
+class QueueEntry:
+    '''A queued track, holding only what playback and the queue display need.'''
+    __slots__ = ('url', 'title', 'prefetch', 'retries', 'requester_id', 'requester_name', 'followup', 'start_at')
+
+    def __init__(self, url: str, *, title: str = None, prefetch = None, retries: int = 0, requester_id: int = None, requester_name: str = None, followup = None, start_at: float = 0):
+        self.url = url
+        self.title = title
+        # task or future resolving to the track data, None until the lookahead gets to it
+        self.prefetch = prefetch
+        # times this track failed to start and was put back
+        self.retries = retries
+        self.requester_id = requester_id
+        self.requester_name = requester_name
+        # interaction webhook used to tell the requester when their track starts
+        self.followup = followup
+        # seconds into the track playback starts at, for resuming after a restart
+        self.start_at = start_at
+
+    @classmethod
+    def from_interaction(cls, url: str, interaction, **kwargs):
+        return cls(
+            url,
+            requester_id = interaction.user.id,
+            requester_name = interaction.user.display_name,
+            followup = interaction.followup,
+            **kwargs
+        )
+
+    def to_dict(self) -> dict:
+        '''The parts of the entry that survive a restart.'''
+        data = self.data
+        title = self.title or (data.get('title') if data else None)
+        result = {'url': self.url, 'title': title, 'requester_id': self.requester_id, 'requester_name': self.requester_name}
+        if self.start_at:
+            # a restored track that hasn't started yet, it should still resume where it left off
+            result['start_at'] = self.start_at
+        return result
+
+    @classmethod
+    def from_dict(cls, data: dict, **kwargs):
+        kwargs.setdefault('start_at', data.get('start_at', 0))
+        return cls(
+            data['url'],
+            title = data.get('title'),
+            requester_id = data.get('requester_id'),
+            requester_name = data.get('requester_name'),
+            **kwargs
+        )
+
+    def retry(self):
+        '''Returns a copy of this entry for another attempt, without its (failed) prefetch.'''
+        return QueueEntry(
+            self.url,
+            title = self.title,
+            retries = self.retries + 1,
+            requester_id = self.requester_id,
+            requester_name = self.requester_name,
+            followup = self.followup,
+            start_at = self.start_at
+        )
+
+    @property
+    def data(self):
+        '''The resolved track data, if the prefetch finished successfully.'''
+        prefetch = self.prefetch
+        if prefetch is None or not prefetch.done() or prefetch.cancelled() or prefetch.exception():
+            return None
+        return prefetch.result()
+
+    @property
+    def display_title(self):
+        data = self.data
+        return self.title or (data.get('title') if data else None) or self.url
+
+class TrackQueue:
+    '''Deque-backed track queue: O(1) at both ends, indexed remove/move/shuffle in between.'''
+
+    def __init__(self):
+        self._entries = deque()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __bool__(self):
+        return bool(self._entries)
+
+    def __iter__(self):
+        return iter(self._entries)
+
+    def __getitem__(self, index: int):
+        return self._entries[index]
+
+    def append(self, entry: QueueEntry):
+        self._entries.append(entry)
+
+    def appendleft(self, entry: QueueEntry):
+        self._entries.appendleft(entry)
+
+    def popleft(self) -> QueueEntry:
+        return self._entries.popleft()
+
+    def head(self, count: int) -> list:
+        '''Returns the first count entries.'''
+        return list(islice(self._entries, count))
+
+    def page(self, page: int, size: int) -> list:
+        '''Returns the entries on a 0-based page of the given size.'''
+        start = page * size
+        return list(islice(self._entries, start, start + size))
+
+    def remove(self, index: int) -> QueueEntry:
+        '''Removes and returns the entry at a 0-based index.'''
+        entry = self._entries[index]
+        del self._entries[index]
+        return entry
+
+    def move(self, source: int, destination: int) -> QueueEntry:
+        '''Moves the entry at source to destination, both 0-based.'''
+        entry = self.remove(source)
+        self._entries.insert(destination, entry)
+        return entry
+
+    def shuffle(self):
+        entries = list(self._entries)
+        random.shuffle(entries)
+        self._entries = deque(entries)
+
+    def clear(self):
+        self._entries.clear()
@@ -0,0 +1,80 @@
+import asyncio
+import sys, threading, time, traceback
+
+class LoopWatchdog:
+    '''Measures event loop lag and dumps the loop thread's stack when it stalls.
+
+    A heartbeat task on the loop checks how late its own sleeps wake up. A
+    separate thread watches the heartbeat, and when it hasn't beaten for
+    threshold seconds it grabs the loop thread's current stack, which is
+    the code blocking the loop at that moment.
+    '''
+
+    def __init__(self, threshold: float = 0.25, interval: float = 0.1, metrics = None, stack_depth: int = 12):
+        self.threshold = threshold
+        self.interval = interval
+        # optional utilities.metrics.Metrics for loop_lag_seconds and loop_stalls
+        self.metrics = metrics
+        self.stack_depth = stack_depth
+
+        self._beat = None
+        self._loop_thread = None
+        self._task = None
+        self._thread = None
+        self._stopped = threading.Event()
+
+        self.stalls = 0
+        # (seconds stalled when caught, innermost frame as 'file:line in function') of the last stall
+        self.last_stall = None
+
+    def start(self):
+        '''Starts watching the running loop. Call from the loop thread.'''
+        if self._task is not None:
+            return
+        self._loop_thread = threading.get_ident()
+        self._beat = time.perf_counter()
+        self._stopped.clear()
+        self._task = asyncio.create_task(self._heartbeat())
+        self._thread = threading.Thread(target = self._watch, name = 'loop-watchdog', daemon = True)
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        self._thread = None
+
+    async def _heartbeat(self):
+        while True:
+            before = time.perf_counter()
+            await asyncio.sleep(self.interval)
+            self._beat = now = time.perf_counter()
+            if self.metrics:
+                self.metrics.observe('loop_lag_seconds', max(0.0, now - before - self.interval))
+
+    def _watch(self):
+        # runs on its own thread, so it keeps going while the loop is blocked
+        reported = None
+        while not self._stopped.wait(self.interval / 2):
+            beat = self._beat
+            stalled = time.perf_counter() - beat
+            # one report per stall, the heartbeat moving on means it's over
+            if stalled < self.threshold or beat == reported:
+                continue
+            reported = beat
+            self._report(stalled)
+
+    def _report(self, stalled: float):
+        frame = sys._current_frames().get(self._loop_thread)
+        if frame is None:
+            return
+        stack = traceback.extract_stack(frame, limit = self.stack_depth)
+        innermost = stack[-1]
+
+        self.stalls += 1
+        self.last_stall = (stalled, f'{innermost.filename}:{innermost.lineno} in {innermost.name}')
+        if self.metrics:
+            self.metrics.increment('loop_stalls')
+
+        print(f'Event loop blocked for {stalled * 1000:.0f} ms so far, loop thread is at:\n{"".join(traceback.format_list(stack))}', end = '')